@@ -1,149 +1,905 @@
 import os
-from flask import Flask, request, abort, jsonify
+import base64
+import hashlib
+import shutil
+import tempfile
+from datetime import date
+from functools import wraps
+from itertools import islice
+from flask import Flask, Response, request, abort, jsonify, json, stream_with_context, g, current_app, send_file
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from flask_migrate import Migrate
-from models import setup_db, Movie, Actor, db
-from auth import AuthError, requires_auth
+from sqlalchemy.exc import IntegrityError
+from models import (setup_db, engine_options, keyset_page, movies_with_actors, iter_movies_with_actors,
+                    iter_actors, insert_many, existing_ids, insert_returning, update_returning,
+                    delete_returning, delete_movie_cascade, current_versions, changes_since, search, sqlalchemy_url,
+                    lock_versions, Movie, Actor, MOVIE_COLUMNS, ACTOR_COLUMNS, db)
+from auth import AuthError, requires_auth, check_permissions
+from ratelimit import Throttled, rate_limiter, load_shedder, make_buckets
+from cache import ResponseCache, make_backend
+from metrics import init_metrics, instrument_pool
+from replicas import replicas
+from query_guard import init_query_guard, query_budget
+from serializers import JSONEncoder, dumps, json_response, rows_to_dicts
+from bulk import import_file, export_file
+from jobs import JobRunner, JobQueueFull
+from config import (pagination_config, bulk_config, cache_config, metrics_config, query_guard_config, search_config,
+                    replica_config, job_config, rate_limit_config, load_shed_config)
+
+MAX_PAGE_SIZE = pagination_config['MAX_PAGE_SIZE']
+STREAM_CHUNK_SIZE = pagination_config['STREAM_CHUNK_SIZE']
+NDJSON = 'application/x-ndjson'
+MAX_BATCH_SIZE = bulk_config['MAX_BATCH_SIZE']
+MAX_BATCH_OPERATIONS = bulk_config['MAX_BATCH_OPERATIONS']
+CASCADE_CHUNK_SIZE = bulk_config['CASCADE_CHUNK_SIZE']
+# searchable kinds: model, permission needed and the key of the matched text
+SEARCH_KINDS = {
+  'movies': (Movie, 'get:movies', 'title'),
+  'actors': (Actor, 'get:actors', 'name')
+}
+# permission needed to import into or export each table, and the job file formats
+IMPORT_PERMISSIONS = {'movies': 'post:movie', 'actors': 'post:actor'}
+EXPORT_PERMISSIONS = {'movies': 'get:movies', 'actors': 'get:actors'}
+JOB_FORMATS = {'csv': 'text/csv', 'ndjson': NDJSON}
+
+
+## Pagination and streaming helpers
+
+def encode_token(data):
+    # cursors are opaque to clients: base64 encoded JSON
+    raw = json.dumps(data).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_token(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except Exception:
+        abort(400, {'message': 'invalid cursor'})
+
+def encode_cursor(last_id):
+    return encode_token({'id': last_id})
+
+def decode_cursor(cursor):
+    try:
+        return int(decode_token(cursor)['id'])
+    except (KeyError, TypeError, ValueError):
+        abort(400, {'message': 'invalid cursor'})
+
+def page_args(args=None):
+    # returns (after_id, limit) from the `cursor` and `limit` query parameters
+    args = request.args if args is None else args
+    limit = limit_arg(args, MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+
+    cursor = args.get('cursor')
+    after_id = decode_cursor(cursor) if cursor else None
+    return after_id, limit
+
+def limit_arg(args, default, maximum):
+    # the `limit` query parameter capped at `maximum`; anything but a positive
+    # integer is a 400 rather than silently using the default
+    value = args.get('limit')
+    if not value:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        abort(400, {'message': 'limit must be a positive integer'})
+    return min(limit, maximum)
+
+def int_arg(args, param):
+    # an integer query parameter, None when absent; anything else is a 400
+    # rather than silently dropping the filter
+    value = args.get(param)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400, {'message': '{} must be an integer'.format(param)})
+
+def actor_filters(args=None):
+    # ?movie_id=, ?gender=, ?age_min= and ?age_max= on /actors
+    args = request.args if args is None else args
+    filters = []
+    movie_id = int_arg(args, 'movie_id')
+    if movie_id is not None:
+        filters.append(Actor.movie_id == movie_id)
+    gender = args.get('gender')
+    if gender:
+        filters.append(Actor.gender == gender)
+    age_min = int_arg(args, 'age_min')
+    if age_min is not None:
+        filters.append(Actor.age >= age_min)
+    age_max = int_arg(args, 'age_max')
+    if age_max is not None:
+        filters.append(Actor.age <= age_max)
+    return filters
+
+def movie_filters(args=None):
+    # ?release_date_from= and ?release_date_to= (YYYY-MM-DD, inclusive) on /movies
+    args = request.args if args is None else args
+    filters = []
+    for param, compare in (('release_date_from', Movie.release_date.__ge__),
+                           ('release_date_to', Movie.release_date.__le__)):
+        value = args.get(param)
+        if value:
+            try:
+                filters.append(compare(date.fromisoformat(value)))
+            except ValueError:
+                abort(400, {'message': '{} must be formatted as YYYY-MM-DD'.format(param)})
+    return filters
+
+def field_columns(columns, args=None):
+    # ?fields=id,title: the subset of `columns` to read, in their usual order.
+    # id is always included, the cursor needs it.
+    args = request.args if args is None else args
+    fields = args.get('fields')
+    if not fields:
+        return columns
+    names = {name.strip() for name in fields.split(',') if name.strip()}
+    unknown = names - {column.key for column in columns}
+    if unknown:
+        abort(400, {'message': 'unknown fields: {}'.format(', '.join(sorted(unknown)))})
+    return tuple(column for column in columns if column.key == 'id' or column.key in names)
+
+def expansions(allowed, default, args=None):
+    # ?expand=actors names the relationships to nest. Without it `default`
+    # applies: the full listing nests them, a ?fields= listing does not.
+    args = request.args if args is None else args
+    if 'expand' not in args:
+        return set(default) if 'fields' not in args else set()
+    names = {name.strip() for name in args.get('expand').split(',') if name.strip()}
+    if names - set(allowed):
+        abort(400, {'message': 'expand supports: {}'.format(', '.join(allowed) or 'nothing')})
+    return names
+
+def cascade_args(movie_id, args=None):
+    # ?cascade=delete removes the movie's actors with it, ?cascade=reassign&to=<id>
+    # moves them to another movie first. Returns (mode or None, target movie).
+    args = request.args if args is None else args
+    mode = args.get('cascade')
+    if mode is None:
+        return None, None
+    if mode not in ('delete', 'reassign'):
+        abort(400, {'message': 'cascade must be delete or reassign'})
+    if not existing_ids(Movie, [movie_id]):
+        abort(404, {'message': 'id {} not found'.format(movie_id)})
+    to = None
+    if mode == 'reassign':
+        to = args.get('to', type=int)
+        if to is None or to == movie_id or not existing_ids(Movie, [to]):
+            abort(422, {'message': 'reassign needs ?to= the id of another existing movie'})
+    return mode, to
+
+def wants_stream():
+    # full exports are opt-in with ?stream=1 or an NDJSON Accept header
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+def chunked(rows, size):
+    rows = iter(rows)
+    chunk = list(islice(rows, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(rows, size))
+
+def stream_listing(key, rows):
+    # Streams `rows` as NDJSON, or as the usual {"success": true, key: [...]}
+    # document, flushing STREAM_CHUNK_SIZE rows at a time so memory stays flat.
+    ndjson = request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+    def generate():
+        if ndjson:
+            for chunk in chunked(rows, STREAM_CHUNK_SIZE):
+                yield b''.join(dumps(row) + b'\n' for row in chunk)
+            return
+        yield b'{"success":true,"' + key.encode('utf-8') + b'":['
+        separator = b''
+        for chunk in chunked(rows, STREAM_CHUNK_SIZE):
+            yield separator + b','.join(dumps(row) for row in chunk)
+            separator = b','
+        yield b']}'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON if ndjson else 'application/json')
+
+def change_feed(model, columns, key):
+    # GET ?since=<cursor>: rows changed after the cursor and the ids deleted
+    # since, with the cursor to resume from. since=0 starts from the beginning.
+    since = request.args.get('since')
+    if since == '0':
+        # from version -1: rows no write has stamped yet (added to the session
+        # directly, or there before the version column) are still at 0
+        since_version, after_id, after_deleted_id = -1, None, None
+    else:
+        cursor = decode_token(since)
+        try:
+            since_version = int(cursor['v'])
+            after_id = None if cursor['id'] is None else int(cursor['id'])
+            after_deleted_id = None if cursor.get('d') is None else int(cursor['d'])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            abort(400, {'message': 'invalid cursor'})
+    limit = limit_arg(request.args, MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+
+    rows, deleted, version, next_id, next_deleted_id, has_more = changes_since(
+        model, columns, since_version, after_id, limit, after_deleted_id)
+    return json_response({
+        'success': True,
+        key: rows_to_dicts(rows, columns),
+        'deleted': deleted,
+        'next_since': encode_token({'v': version, 'id': next_id, 'd': next_deleted_id}),
+        'has_more': has_more
+    })
+
+def make_etag(path, query_string, tables, versions):
+    tag = '{}?{}|{}'.format(path, query_string.decode('latin-1'),
+                            ','.join('{}:{}'.format(t, versions[t]) for t in tables))
+    return hashlib.sha1(tag.encode('utf-8')).hexdigest()
+
+def conditional(*tables):
+    # Strong ETag built from the versions of `tables` and the request's query
+    # string. A matching If-None-Match gets a 304 before any row is loaded or
+    # serialized. The header itself is added by the after_request hook.
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if wants_stream():
+                return f(*args, **kwargs)
+
+            g.etag = make_etag(request.path, request.query_string, tables, current_versions(tables))
+            if request.if_none_match.contains(g.etag):
+                return Response(status=304)
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def next_cursor(rows, has_more):
+    if not has_more:
+        return None
+    last = rows[-1]
+    return encode_cursor(last['id'] if isinstance(last, dict) else last.id)
+
+
+
+## Validation helpers
+# These return (values, None) for a valid body or (None, message) otherwise,
+# so bulk requests can report every invalid item at once.
+
+def validate_movie(body, partial=False):
+    # with partial=True (PATCH) only the keys present in the body are checked
+    if not isinstance(body, dict):
+        return None, 'item must be a JSON object'
+
+    values = {}
+    if not partial or 'title' in body:
+        if not body.get('title', None):
+            return None, 'No title given'
+        if not isinstance(body['title'], str):
+            return None, 'title must be a string'
+        values['title'] = body['title']
+
+    if not partial or 'release_date' in body:
+        release_date = body.get('release_date', None)
+        if isinstance(release_date, str):
+            try:
+                release_date = date.fromisoformat(release_date)
+            except ValueError:
+                return None, 'release_date must be formatted as YYYY-MM-DD'
+        elif release_date is not None and not isinstance(release_date, date):
+            return None, 'release_date must be formatted as YYYY-MM-DD'
+        values['release_date'] = release_date
+
+    if not values:
+        return None, 'nothing to update'
+    return values, None
+
+def validate_actor(body, partial=False):
+    if not isinstance(body, dict):
+        return None, 'item must be a JSON object'
+
+    values = {}
+    if not partial or 'name' in body:
+        if not body.get('name', None):
+            return None, 'no name provided.'
+        if not isinstance(body['name'], str):
+            return None, 'name must be a string.'
+        values['name'] = body['name']
+
+    if not partial or 'age' in body:
+        age = body.get('age', None)
+        if not age:
+            return None, 'no age provided.'
+        # bool is an int subclass, true would be stored as 1
+        if not isinstance(age, int) or isinstance(age, bool):
+            return None, 'age must be an integer.'
+        values['age'] = age
+
+    if not partial or 'gender' in body:
+        gender = body.get('gender', None)
+        if gender is not None and not isinstance(gender, str):
+            return None, 'gender must be a string.'
+        values['gender'] = gender
+
+    if not partial or 'movie_id' in body:
+        movie_id = body.get('movie_id', None)
+        if not isinstance(movie_id, int) or isinstance(movie_id, bool):
+            return None, 'no movie_id provided.'
+        values['movie_id'] = body['movie_id']
+
+    if not values:
+        return None, 'nothing to update'
+    return values, None
+
+def validate_batch(items, validate):
+    # returns (rows, errors): (index, values) for every valid item and
+    # {'index', 'message'} for every invalid one
+    if len(items) == 0:
+        abort(400, {'message': 'empty batch'})
+    if len(items) > MAX_BATCH_SIZE:
+        abort(413, {'message': 'batch larger than {} items'.format(MAX_BATCH_SIZE)})
+
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        values, error = validate(item)
+        if error:
+            errors.append({'index': index, 'message': error})
+        else:
+            rows.append((index, values))
+    return rows, errors
+
+def batch_errors(errors):
+    return jsonify({
+        'success': False,
+        'error': 422,
+        'message': 'Unprocessable',
+        'errors': sorted(errors, key=lambda error: error['index'])
+    }), 422
+
+
+## Batch operations
+# POST /batch runs a list of {"path": "movies/create", "body": {...}, "ref": "m1"}
+# operations in one transaction. "$m1" in a later path or body value stands
+# for the id created by the operation with "ref": "m1".
+
+BATCH_OPERATIONS = {
+  ('movies', 'create'): 'post:movie',
+  ('actors', 'create'): 'post:actor',
+  ('movies', 'patch'): 'patch:movies',
+  ('actors', 'patch'): 'patch:actors',
+  ('movies', 'delete'): 'delete:movie',
+  ('actors', 'delete'): 'delete:actor'
+}
+
+class BatchError(Exception):
+    def __init__(self, index, status, message):
+        self.index = index
+        self.status = status
+        self.message = message
+
+def parse_operation(index, operation):
+    # returns (table, action, id or reference, body)
+    if not isinstance(operation, dict) or not isinstance(operation.get('path'), str):
+        raise BatchError(index, 400, 'operation must be an object with a path')
+    parts = operation['path'].strip('/').split('/')
+    if tuple(parts[:2]) not in BATCH_OPERATIONS or len(parts) != (2 if parts[1] == 'create' else 3):
+        raise BatchError(index, 400, 'unknown operation {}'.format(operation['path']))
+    body = operation.get('body', {})
+    if not isinstance(body, dict):
+        raise BatchError(index, 400, 'body must be a JSON object')
+    return parts[0], parts[1], parts[2] if len(parts) == 3 else None, body
+
+def resolve_ref(index, value, refs):
+    # "$name" to the id created under that name, ints and other values as is
+    if isinstance(value, str) and value.startswith('$'):
+        if value[1:] not in refs:
+            raise BatchError(index, 422, 'unknown reference {}'.format(value))
+        return refs[value[1:]]
+    return value
+
+def run_operation(index, table, action, target, body, refs):
+    # one operation inside the batch transaction; returns its result
+    model, columns, validate = (Movie, MOVIE_COLUMNS, validate_movie) if table == 'movies' \
+        else (Actor, ACTOR_COLUMNS, validate_actor)
+    body = {key: resolve_ref(index, value, refs) for key, value in body.items()}
+    if target is not None:
+        try:
+            target = int(resolve_ref(index, target, refs))
+        except (TypeError, ValueError):
+            raise BatchError(index, 400, 'invalid id {}'.format(target))
+
+    if action != 'delete':
+        body, error = validate(body, partial=action == 'patch')
+        if error:
+            raise BatchError(index, 422, error)
+        if 'movie_id' in body and table == 'actors' and not existing_ids(Movie, [body['movie_id']]):
+            raise BatchError(index, 422, 'movie {} not found'.format(body['movie_id']))
+
+    key = table[:-1]
+    if action == 'create':
+        row = insert_returning(model, body, columns, commit=False)
+        return {'index': index, 'created': row['id'], key: row}
+    if action == 'patch':
+        row = update_returning(model, target, body, columns, commit=False)
+        if row is None:
+            raise BatchError(index, 404, 'id {} not found'.format(target))
+        return {'index': index, 'updated': target, key: row}
+    if not delete_returning(model, target, commit=False):
+        raise BatchError(index, 404, 'id {} not found'.format(target))
+    return {'index': index, 'deleted': target}
+
+
+## Background jobs
+
+def wants_async():
+    return request.args.get('async') in ('1', 'true')
+
+def job_format(args=None):
+    # ?format=, else the upload's Content-Type, else CSV
+    args = request.args if args is None else args
+    fmt = args.get('format') or ('ndjson' if request.mimetype == NDJSON else 'csv')
+    if fmt not in JOB_FORMATS:
+        abort(400, {'message': 'format must be csv or ndjson'})
+    return fmt
+
+def public_job(record):
+    return {key: value for key, value in record.items() if key != 'owner'}
+
+def owned_job(job_id, payload):
+    # jobs are only visible to the subject that started them
+    record = current_app.extensions['jobs'].get(job_id)
+    if record is None or record['owner'] != payload.get('sub'):
+        abort(404, {'message': 'job {} not found'.format(job_id)})
+    return record
+
+def retry_later(status, message, retry_after):
+    response = jsonify({
+      'success': False,
+      'error': status,
+      'message': message
+    })
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def start_job(kind, payload, f, *args):
+    # 202 with the job and a Location to poll, 503 when the queue is full
+    try:
+        record = current_app.extensions['jobs'].submit(kind, payload.get('sub'), f, *args)
+    except JobQueueFull:
+        return retry_later(503, 'too many jobs queued', 30)
+    response = jsonify({'success': True, 'job': public_job(record)})
+    response.status_code = 202
+    response.headers['Location'] = '/jobs/' + record['id']
+    return response
+
+def import_job(progress, table, path, fmt):
+    validate = validate_movie if table == 'movies' else validate_actor
+    try:
+        return import_file(table, path, validate, fmt, progress=progress)
+    finally:
+        os.remove(path)
+
+def export_job(progress, table, fmt):
+    path = progress.runner.path(progress.job_id, fmt)
+    try:
+        result = export_file(table, path, fmt, progress=progress)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return dict(result, format=fmt, download='/jobs/{}/result'.format(progress.job_id))
+
+def cascade_job(progress, movie_id, mode, to):
+    deleted, affected = delete_movie_cascade(movie_id, mode, to, CASCADE_CHUNK_SIZE, progress)
+    return {
+      'deleted': movie_id if deleted else None,
+      'actors_deleted' if mode == 'delete' else 'actors_reassigned': affected
+    }
 
 
 def create_app(test_config=None):
-    app = Flask(__name__)
-    CORS(app)
-    setup_db(app)
+  app = Flask(__name__)
+  app.json_encoder = JSONEncoder
+  app.config.from_mapping(query_guard_config)
+  app.config.from_mapping(replica_config)
+  app.config.from_mapping(job_config)
+  app.config.from_mapping(rate_limit_config)
+  app.config.from_mapping(load_shed_config)
+  if test_config:
+    app.config.from_mapping(test_config)
+  CORS(app)
+  setup_db(app)
+
+  response_cache = ResponseCache(make_backend(cache_config), ttl=cache_config['CACHE_TTL'],
+                                 enabled=cache_config['CACHE_ENABLED'])
+  app.extensions['response_cache'] = response_cache
+
+  # GET views read from the replicas, pins are shared like the response cache
+  replicas.configure([sqlalchemy_url(url) for url in app.config['DATABASE_REPLICA_URLS']],
+                     app.config['REPLICA_HEALTH_CHECK_INTERVAL'],
+                     app.config['REPLICA_PIN_SECONDS'], pins=make_backend(cache_config),
+                     engine_options=engine_options)
+
+  # job records are shared like the response cache
+  jobs = JobRunner(app, make_backend(cache_config), app.config['JOB_WORKERS'], app.config['JOB_MAX_QUEUED'],
+                   app.config['JOB_TTL'], app.config['JOB_DIR'])
+  app.extensions['jobs'] = jobs
+
+  if metrics_config['METRICS_ENABLED']:
+    init_metrics(app, db)
+    for replica in replicas.replicas:
+      instrument_pool(replica.engine, replica.name)
+    instrument_pool(jobs.engine, 'jobs')
+  init_query_guard(app, app.config['QUERY_GUARD'], app.config['QUERY_GUARD_MAX_REPEATS'])
+
+  # admission control in requires_auth, buckets are shared like the response cache
+  rate_limiter.configure(app.config['RATE_LIMIT_ENABLED'], app.config['RATE_LIMIT_RATE'],
+                         app.config['RATE_LIMIT_BURST'], app.config['RATE_LIMITS'], make_buckets(app.config))
+  load_shedder.configure(app.config['SHED_MAX_IN_FLIGHT'], app.config['SHED_MAX_POOL_WAIT'],
+                         app.config['SHED_RETRY_AFTER'])
+  if app.config['SHED_MAX_POOL_WAIT']:
+    load_shedder.watch(db.engine)
+
+  @app.teardown_request
+  def release_session(exc):
+    # Hands the request's connection back to the pool once the response,
+    # streamed or not, is done. Flask-SQLAlchemy only does this when the app
+    # context ends, which outlives the request under the test client and CLI.
+    db.session.remove()
 
   @app.after_request
   def after_request(response):
     # Adding access headers
-      response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization, true')
+      response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization, If-None-Match, true')
       response.headers.add('Access-Control-Allow-Methods', 'GET, PATCH, POST, DELETE, OPTIONS')
+      response.headers.add('Access-Control-Expose-Headers', 'ETag')
+      # ETag computed by @conditional
+      if 'etag' in g and response.status_code in (200, 304):
+        response.set_etag(g.etag)
       return response
   
   @app.route('/movies')
   @requires_auth('get:movies')
+  @query_budget(4)
+  @replicas.reads
+  @conditional('movies', 'actors')
+  @response_cache.cached('movies', 'actors', unless=wants_stream)
   def get_movies(token):
-      movies = Movie.query.all()
-      movie_names = [movie.format() for movie in movies]
-
-      if len(movie_names) == 0:
+      columns = field_columns(MOVIE_COLUMNS)
+      expand = 'actors' in expansions(('actors',), ('actors',))
+      if wants_stream():
+        return stream_listing('movies', iter_movies_with_actors(STREAM_CHUNK_SIZE, movie_filters(), columns, expand))
+      if 'since' in request.args:
+        return change_feed(Movie, MOVIE_COLUMNS, 'movies')
+
+      after_id, limit = page_args()
+      filters = movie_filters()
+      movie_names, has_more = movies_with_actors(after_id, limit, filters, columns, expand)
+
+      if len(movie_names) == 0 and after_id is None and not filters:
         abort(404,{'message':'No movie found in database'})
 
-      for movie in movie_names:
-        movie['actors'] = [i.format() for i in movie_names['actors']]
-      return jsonify({
+      return json_response({
         'success': True,
-        'movies': movie_names
+        'movies': movie_names,
+        'next_cursor': next_cursor(movie_names, has_more)
       })
   
   @app.route('/actors')
   @requires_auth('get:actors')
+  @query_budget(4)
+  @replicas.reads
+  @conditional('actors')
+  @response_cache.cached('actors', unless=wants_stream)
   def get_actors(token):
-      actors = Actor.query.all()
-      actor_names = [actor.format() for actor in actors]
+      columns = field_columns(ACTOR_COLUMNS)
+      expansions((), ()) # actors have nothing to expand, rejects ?expand=
+      if wants_stream():
+        return stream_listing('Actors', iter_actors(STREAM_CHUNK_SIZE, actor_filters(), columns))
+      if 'since' in request.args:
+        return change_feed(Actor, ACTOR_COLUMNS, 'Actors')
+
+      after_id, limit = page_args()
+      filters = actor_filters()
+      actors, has_more = keyset_page(Actor, after_id, limit, columns, filters)
+      actor_names = rows_to_dicts(actors, columns)
       
-      if len(actor_names) == 0:
+      if len(actor_names) == 0 and after_id is None and not filters:
         abort(404,{'message':'No actor found in database'})
       
+      return json_response({
+        'success': True,
+        'Actors':actor_names,
+        'next_cursor': next_cursor(actors, has_more)
+      })
+
+  @app.route('/search')
+  @requires_auth()
+  @query_budget(4)
+  @replicas.reads
+  def search_catalog(payload):
+      # ?q= over movie titles and actor names, ?type=movies|actors to search
+      # one kind. Without ?type= every kind the token may read is searched.
+      q = request.args.get('q', '').strip()
+      if not q or len(q) > search_config['SEARCH_MAX_QUERY_LENGTH']:
+        abort(400, {'message': 'q must be between 1 and {} characters'.format(search_config['SEARCH_MAX_QUERY_LENGTH'])})
+
+      kind = request.args.get('type')
+      if kind:
+        if kind not in SEARCH_KINDS:
+          abort(400, {'message': 'type must be one of {}'.format(', '.join(sorted(SEARCH_KINDS)))})
+        check_permissions(SEARCH_KINDS[kind][1], payload)
+        kinds = [kind]
+      else:
+        kinds = [k for k, (model, permission, key) in sorted(SEARCH_KINDS.items())
+                 if permission in payload.get('permissions', [])]
+        if not kinds:
+          check_permissions('get:movies', payload)
+
+      limit = limit_arg(request.args, search_config['SEARCH_PAGE_SIZE'], search_config['SEARCH_MAX_PAGE_SIZE'])
+      cursor = request.args.get('cursor')
+      try:
+        offset = int(decode_token(cursor)['offset']) if cursor else 0
+      except (KeyError, TypeError, ValueError):
+        abort(400, {'message': 'invalid cursor'})
+
+      result = {'success': True}
+      more = False
+      for k in kinds:
+        model, permission, key = SEARCH_KINDS[k]
+        rows, has_more = search(model, q, limit, offset, search_config['SEARCH_CANDIDATES'])
+        result[k] = [{'id': row.id, key: row.text} for row in rows]
+        more = more or has_more
+      result['next_cursor'] = encode_token({'offset': offset + limit}) if more else None
+      return json_response(result)
+
+  @app.route('/batch', methods=['POST'])
+  @requires_auth()
+  @query_budget(max_repeats=None)
+  @replicas.writes
+  @response_cache.invalidates('movies', 'actors')
+  def run_batch(payload):
+      # The token is verified once and every operation's permission checked
+      # against it before anything runs. Then the operations run in order in
+      # a single transaction, which is rolled back as a whole when one fails.
+      # The version rows of the tables it writes are locked first, so batches
+      # touching the same tables in different orders cannot deadlock.
+      body = request.get_json()
+      operations = body.get('operations') if isinstance(body, dict) else None
+      if not isinstance(operations, list) or not operations:
+        abort(400, {'message': 'operations must be a non empty list'})
+      if len(operations) > MAX_BATCH_OPERATIONS:
+        abort(413, {'message': 'more than {} operations'.format(MAX_BATCH_OPERATIONS)})
+
+      refs = {}
+      results = []
+      try:
+        parsed = [parse_operation(index, operation) for index, operation in enumerate(operations)]
+        for table, action, target, operation_body in parsed:
+          check_permissions(BATCH_OPERATIONS[(table, action)], payload)
+
+        lock_versions(table for table, action, target, operation_body in parsed)
+        for index, (table, action, target, operation_body) in enumerate(parsed):
+          try:
+            result = run_operation(index, table, action, target, operation_body, refs)
+          except IntegrityError:
+            raise BatchError(index, 422, 'violates a constraint, e.g. a movie that still has actors')
+          if action == 'create' and operations[index].get('ref'):
+            refs[str(operations[index]['ref'])] = result['created']
+          results.append(result)
+        db.session.commit()
+      except BatchError as e:
+        db.session.rollback()
+        return jsonify({
+          'success': False,
+          'error': e.status,
+          'message': e.message,
+          'index': e.index
+        }), e.status
+      except Exception:
+        db.session.rollback()
+        raise
+
       return jsonify({
         'success': True,
-        'Actors':actor_names
+        'results': results
       })
 
+  @app.route('/import/<table>', methods=['POST'])
+  @requires_auth()
+  @query_budget(0)
+  @replicas.writes
+  def import_table(payload, table):
+      # The body is a CSV or NDJSON file, as for `manage.py import`. It is
+      # spooled to JOB_DIR and loaded by a background job.
+      if table not in IMPORT_PERMISSIONS:
+        abort(404, {'message': 'no table {}'.format(table)})
+      check_permissions(IMPORT_PERMISSIONS[table], payload)
+      if not request.content_length:
+        abort(400, {'message': 'the request has no file'})
+      if request.content_length > app.config['JOB_MAX_UPLOAD_BYTES']:
+        abort(413, {'message': 'files over {} bytes'.format(app.config['JOB_MAX_UPLOAD_BYTES'])})
+
+      fmt = job_format()
+      fd, path = tempfile.mkstemp(suffix='.' + fmt, prefix='upload-', dir=jobs.directory)
+      with os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(request.stream, f)
+      response = start_job('import:' + table, payload, import_job, table, path, fmt)
+      if response.status_code != 202:
+        os.remove(path)
+      return response
+
+  @app.route('/export/<table>', methods=['POST'])
+  @requires_auth()
+  @query_budget(0)
+  def export_table(payload, table):
+      # ?format=csv or ndjson; the file is downloaded from /jobs/<id>/result
+      if table not in EXPORT_PERMISSIONS:
+        abort(404, {'message': 'no table {}'.format(table)})
+      check_permissions(EXPORT_PERMISSIONS[table], payload)
+      return start_job('export:' + table, payload, export_job, table, job_format())
+
+  @app.route('/jobs/<job_id>')
+  @requires_auth()
+  @query_budget(0)
+  def get_job(payload, job_id):
+      return jsonify({
+        'success': True,
+        'job': public_job(owned_job(job_id, payload))
+      })
+
+  @app.route('/jobs/<job_id>/result')
+  @requires_auth()
+  @query_budget(0)
+  def get_job_result(payload, job_id):
+      record = owned_job(job_id, payload)
+      if not record['kind'].startswith('export:') or record['status'] != 'succeeded':
+        abort(404, {'message': 'job {} has no file'.format(job_id)})
+      fmt = record['result']['format']
+      path = jobs.path(job_id, fmt)
+      if not os.path.exists(path):
+        abort(404, {'message': 'the file of job {} is gone'.format(job_id)})
+      return send_file(path, mimetype=JOB_FORMATS[fmt], as_attachment=True,
+                       attachment_filename='{}.{}'.format(record['kind'].split(':')[1], fmt))
+
   @app.route('/movies/create', methods=['POST'])
   @requires_auth('post:movie')
+  @query_budget(8, max_repeats=None)
+  @replicas.writes
+  @response_cache.invalidates('movies')
   def post_new_movie(token):
       body = request.get_json()
 
       if not body:
         abort(400,{'message':'Require JSON body does not exist'})
 
-      title = body.get('title', None)
-      release_date = body.get('release_date', None)
+      if isinstance(body, list):
+        rows, errors = validate_batch(body, validate_movie)
+        if errors:
+          return batch_errors(errors)
+
+        return jsonify({
+          'success': True,
+          'created': insert_many(Movie, [values for index, values in rows])
+        })
 
-      if not title:
-        abort(422,{'message':'No title given'})
+      values, error = validate_movie(body)
+      if error:
+        abort(422,{'message':error})
 
-      movie = Movie(title=title, release_date=release_date)
-      movie.insert()
-      new_movie = Movie.query.get(movie.id)
-      new_movie = new_movie.format()
+      new_movie = insert_returning(Movie, values, MOVIE_COLUMNS)
+      new_movie['actors'] = []
 
       return jsonify({
         'success': True,
-        'created': movie.id,
+        'created': new_movie['id'],
         'new_movie': new_movie
       })
 
   @app.route('/actors/create', methods=['POST'])
   @requires_auth('post:actor')
+  @query_budget(8, max_repeats=None)
+  @replicas.writes
+  @response_cache.invalidates('actors')
   def post_new_actor(token):
       body = request.get_json()
 
       if not body:
         abort(400,{'message':'request does not contain a valid JSON body'})
-      
-      name = body.get('name', None)
-      age = body.get('age', None)
-
-      if not name:
-      abort(422, {'message': 'no name provided.'})
 
-      if not age:
-      abort(422, {'message': 'no age provided.'})
-
-      gender = body.get('gender', None)
-      movie_id = body.get('movie_id', None)
-
-      actor = Actor(name=name, age=age, gender=gender, movie_id=movie_id)
-      actor.insert()
-      new_actor = Actor.query.get(actor.id)
-      new_actor = new_actor.format()
+      if isinstance(body, list):
+        rows, errors = validate_batch(body, validate_actor)
+        # every referenced movie is checked with a single query
+        known_movies = existing_ids(Movie, [values['movie_id'] for index, values in rows])
+        errors += [{'index': index, 'message': 'movie {} not found'.format(values['movie_id'])}
+                   for index, values in rows if values['movie_id'] not in known_movies]
+        if errors:
+          return batch_errors(errors)
+
+        return jsonify({
+          'success': True,
+          'created': insert_many(Actor, [values for index, values in rows])
+        })
+
+      values, error = validate_actor(body)
+      if error:
+        abort(422, {'message': error})
+
+      try:
+        new_actor = insert_returning(Actor, values, ACTOR_COLUMNS)
+      except IntegrityError:
+        abort(422, {'message': 'movie {} not found'.format(values['movie_id'])})
 
       return jsonify({
         'success': True,
-        'created': actor.id,
+        'created': new_actor['id'],
         'new_actor': new_actor
       })
 
   @app.route('/movies/delete/<int:movie_id>', methods=['DELETE'])
   @requires_auth('delete:movie')
+  @query_budget(max_repeats=None) # a cascade issues a few statements per chunk of actors
+  @replicas.writes
+  @response_cache.invalidates('movies', 'actors')
   def delete_movie(token, movie_id):
 
       if not movie_id:
         abort(400,{'message':'Append a movie id'})
 
-      movie_to_be_deleted=Movie.query.filter(Movie.id == movie_id).one_or_more()
-
-      if not movie_to_be_deleted:
+      mode, to = cascade_args(movie_id)
+      if mode and wants_async():
+        # large casts: 202 now, progress on /jobs/<id>
+        return start_job('cascade', token, cascade_job, movie_id, mode, to)
+
+      affected = 0
+      try:
+        if mode:
+          deleted, affected = delete_movie_cascade(movie_id, mode, to, CASCADE_CHUNK_SIZE)
+        else:
+          deleted = delete_returning(Movie, movie_id)
+      except IntegrityError:
+        abort(422,{'message':'movie {} still has actors'.format(movie_id)})
+
+      if not deleted:
         abort(404,{'message':'id {} not found'.format(movie_id)})
 
-      db.session.commit()
-      db.session.close()
-      return jsonify({
+      result = {
         "success": True,
+        "deleted": movie_id,
         "message" : "Delete occured"
-      })
+      }
+      if mode:
+        result['actors_deleted' if mode == 'delete' else 'actors_reassigned'] = affected
+      return jsonify(result)
 
   @app.route('/actors/delete/<int:actor_id>', methods=['DELETE'])
   @requires_auth('delete:actor')
+  @query_budget(4)
+  @replicas.writes
+  @response_cache.invalidates('actors')
   def delete_actor(token, actor_id):
 
       if not actor_id:
         abort(400,{'message':'Append a actor id'})
 
-      actor_to_delete = Actor.query.filter(Actor.id == actor_id).one_or_more()
-      if not actor_to_delete:
+      if not delete_returning(Actor, actor_id):
         abort(404,{'message':'id {} not found'.format(actor_id)})
 
-      db.session.commit()
-      db.session.close()
       return jsonify({
         "success": True,
+        "deleted": actor_id,
         "message" : "Delete occured"
       })
 
   @app.route('/actors/patch/<int:actor_id>', methods=['PATCH'])
   @requires_auth('patch:actors')
+  @query_budget(4)
+  @replicas.writes
+  @response_cache.invalidates('actors')
   def patch_actor(toekn, actor_id):
       body = request.get_json()
 
@@ -152,48 +908,48 @@ def create_app(test_config=None):
       if not body:
         abort(400,{'message':'Does not have valid JSON body'})
 
-      actor = Actor.query.filter(Actor.id == actor_id)
-      if not actor:
-        abort(404,{'message':'Actor with id {} not found in database'.format(actor_id)})
-
-      name = body.get('name', None)
-      age = body.get('age', None)
-      gender = body.get('gender', None)
-      movie_id = body.get('movie_id', None)
+      values, error = validate_actor(body, partial=True)
+      if error:
+        abort(422,{'message':error})
 
-      # adding new actor
+      try:
+        actor = update_returning(Actor, actor_id, values, ACTOR_COLUMNS)
+      except IntegrityError:
+        abort(422,{'message':'movie {} not found'.format(values['movie_id'])})
 
-      actor.name = name
-      actor.age = age
-      actor.gender = gender
-      actor.movie_id = movie_id
-
-      actor.update()
+      if not actor:
+        abort(404,{'message':'Actor with id {} not found in database'.format(actor_id)})
 
       return jsonify({
         "success": True,
+        "updated": actor_id,
+        "actor": actor,
         "message": "update occured"
       })
     
-  @app.route('/movies/patch/<int:movie_id>')
+  @app.route('/movies/patch/<int:movie_id>', methods=['PATCH'])
   @requires_auth('patch:movies')
+  @query_budget(4)
+  @replicas.writes
+  @response_cache.invalidates('movies')
   def patch_movie(token, movie_id):
       
       body = request.get_json()
       if not body:
         abort(400,{'message':'No JSON body associated'})
 
-      movie = Movie.query.filter(Movie.id == movie_id)
-      if not body:
+      values, error = validate_movie(body, partial=True)
+      if error:
+        abort(422,{'message':error})
+
+      movie = update_returning(Movie, movie_id, values, MOVIE_COLUMNS)
+      if not movie:
         abort(404,{'message':'Movie id {} not found'.format(movie_id)})
-      
-      title = body.get('title', None)
-      release_date = body.get('release_date', None)
-      movie.title = title
-      movie.release_date = release_date
-      movie.update()
+
       return jsonify({
         "success": True,
+        "updated": movie_id,
+        "movie": movie,
         "message": "update occured"
       })
       
@@ -203,9 +959,13 @@ def create_app(test_config=None):
   def failed_authorization(error):
       return jsonify({
         'success': False,
-        'error': AuthError.status_code,
-        'message': AuthError.error['description']
-      }), AuthError.status_code
+        'error': error.status_code,
+        'message': error.error['description']
+      }), error.status_code
+
+  @app.errorhandler(Throttled)
+  def throttled(error):
+      return retry_later(error.status_code, error.message, error.retry_after)
 
   @app.errorhandler(400)
   def bad_request(error):
@@ -223,6 +983,14 @@ def create_app(test_config=None):
         'message' : 'Not Found'
       }), 404
 
+  @app.errorhandler(413)
+  def too_large(error):
+      return jsonify({
+        'success': False,
+        'error': 413,
+        'message': 'Payload Too Large'
+      }), 413
+
   @app.errorhandler(422)
   def unprocessable(error):
       return jsonify({
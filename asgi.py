@@ -0,0 +1,207 @@
+from sqlalchemy import select
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from auth import AuthError, parse_auth_header, check_permissions, get_verified_claims, token_cache
+from ratelimit import Throttled, rate_limiter, load_shedder
+from app import app as wsgi_app, page_args, actor_filters, movie_filters, make_etag, next_cursor
+from models import database_path, sqlalchemy_url, Movie, Actor, TableVersion, MOVIE_COLUMNS, ACTOR_COLUMNS
+from serializers import dumps
+from config import async_config
+
+try:
+    from a2wsgi import WSGIMiddleware
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from starlette.concurrency import run_in_threadpool
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse, Response
+except ImportError as e:
+    raise ImportError('the ASGI mode needs the packages in requirements-async.txt ({})'.format(e))
+
+# ASGI entry point, one process serving many concurrent requests:
+#
+#   uvicorn asgi:app --workers 2
+#
+# The keyset pages of GET /movies and GET /actors are served natively on an
+# async engine. Token verification runs on the thread pool on a token cache
+# miss, so a JWKS fetch never blocks the event loop. Every other request goes
+# to the Flask app (app.py) on the thread pool, so routes, responses and
+# requires_auth behave exactly as under gunicorn.
+
+
+def async_database_url(url):
+    # DATABASE_URL with an async driver
+    url = sqlalchemy_url(url)
+    for scheme, driver in (('postgresql://', 'postgresql+asyncpg://'), ('sqlite://', 'sqlite+aiosqlite://')):
+        if url.startswith(scheme):
+            return driver + url[len(scheme):]
+    return url
+
+
+def make_engine():
+    url = async_config['ASYNC_DATABASE_URL'] or async_database_url(database_path)
+    if url.startswith('sqlite'):
+        return create_async_engine(url)
+    return create_async_engine(url, pool_size=async_config['ASYNC_POOL_SIZE'],
+                               max_overflow=async_config['ASYNC_MAX_OVERFLOW'], pool_pre_ping=True)
+
+
+def str_server_port(app):
+    # a2wsgi 1.7, the last release for Python 3.7, sets SERVER_PORT to
+    # the int from the ASGI scope, Werkzeug needs the str of PEP 3333 when
+    # there is no Host header
+    def wrapper(environ, start_response):
+        environ['SERVER_PORT'] = str(environ['SERVER_PORT'])
+        return app(environ, start_response)
+    return wrapper
+
+
+engine = make_engine()
+wsgi = WSGIMiddleware(str_server_port(wsgi_app))
+# what flask_cors and app.after_request add to the Flask responses
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, If-None-Match, true',
+    'Access-Control-Allow-Methods': 'GET, PATCH, POST, DELETE, OPTIONS',
+    'Access-Control-Expose-Headers': 'ETag'
+}
+
+
+## Auth
+
+async def authenticate(request, permission):
+    # requires_auth for async views: returns the payload or raises AuthError.
+    # A cached token is checked inline, anything else is verified on a thread.
+    load_shedder.check()
+    token = parse_auth_header(request.headers.get('Authorization'))
+    entry = token_cache.get(token)
+    if entry is None:
+        try:
+            entry = await run_in_threadpool(get_verified_claims, token)
+        except Exception:
+            raise AuthError({'code': 'invalid_token', 'description': 'Unauthorized'}, 401)
+    exp, payload, granted = entry
+    if permission:
+        check_permissions(permission, payload, granted)
+    rate_limiter.check(payload.get('sub'), permission)
+    return payload
+
+
+def error_response(status, message, headers=None):
+    return JSONResponse({'success': False, 'error': status, 'message': message}, status_code=status,
+                        headers=headers)
+
+
+def json_response(body, etag):
+    response = Response(dumps(body), media_type='application/json')
+    response.headers['ETag'] = '"{}"'.format(etag)
+    return response
+
+
+## Queries
+
+async def current_versions(conn, names):
+    table = TableVersion.__table__
+    rows = await conn.execute(select(table.c.name, table.c.version).where(table.c.name.in_(names)))
+    versions = {name: 0 for name in names}
+    versions.update((row.name, row.version) for row in rows)
+    return versions
+
+
+async def keyset_page(conn, model, columns, after_id, limit, filters):
+    query = select(*columns).where(*filters).order_by(model.id)
+    if after_id is not None:
+        query = query.where(model.id > after_id)
+    rows = (await conn.execute(query.limit(limit + 1))).all()
+    return rows[:limit], len(rows) > limit
+
+
+async def actors_by_movie(conn, movie_ids):
+    grouped = {movie_id: [] for movie_id in movie_ids}
+    if movie_ids:
+        rows = await conn.execute(select(*ACTOR_COLUMNS).where(Actor.movie_id.in_(movie_ids))
+                                  .order_by(Actor.movie_id, Actor.id))
+        for row in rows:
+            grouped[row.movie_id].append(dict(row._mapping))
+    return grouped
+
+
+## Views
+
+def listing(model, columns, key, permission, tables, filters, nest=None):
+    async def view(request):
+        try:
+            await authenticate(request, permission)
+            args = MultiDict(request.query_params.multi_items())
+            after_id, limit = page_args(args)
+            where = filters(args)
+        except AuthError as e:
+            return error_response(e.status_code, e.error['description'])
+        except Throttled as e:
+            return error_response(e.status_code, e.message, {'Retry-After': str(e.retry_after)})
+        except HTTPException as e:
+            return error_response(e.code, e.name)
+
+        with load_shedder.track():
+            async with engine.connect() as conn:
+                etag = make_etag(request.url.path, request.scope['query_string'], tables,
+                                 await current_versions(conn, tables))
+                if '"{}"'.format(etag) in request.headers.get('If-None-Match', ''):
+                    return Response(status_code=304, headers={'ETag': '"{}"'.format(etag)})
+
+                rows, has_more = await keyset_page(conn, model, columns, after_id, limit, where)
+                items = [dict(row._mapping) for row in rows]
+                if nest is not None:
+                    grouped = await nest(conn, [item['id'] for item in items])
+                    for item in items:
+                        item['actors'] = grouped[item['id']]
+
+        if not items and after_id is None and not where:
+            return error_response(404, 'Not Found')
+        return json_response({'success': True, key: items, 'next_cursor': next_cursor(items, has_more)}, etag)
+    return view
+
+
+def native(request):
+    # streams, the change feed and narrowed listings are left to the Flask app
+    return request.method == 'GET' and 'since' not in request.query_params \
+        and 'fields' not in request.query_params and 'expand' not in request.query_params \
+        and request.query_params.get('stream') not in ('1', 'true') \
+        and 'application/x-ndjson' not in request.headers.get('Accept', '')
+
+
+class ASGIApp:
+
+    def __init__(self, views):
+        self.views = views
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['path'] in self.views:
+            request = Request(scope, receive)
+            if native(request):
+                response = await self.views[scope['path']](request)
+                response.headers.update(CORS_HEADERS)
+                return await response(scope, receive, send)
+        await wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_asgi_app():
+    return ASGIApp({
+        '/movies': listing(Movie, MOVIE_COLUMNS, 'movies', 'get:movies', ('movies', 'actors'), movie_filters,
+                           nest=actors_by_movie),
+        '/actors': listing(Actor, ACTOR_COLUMNS, 'Actors', 'get:actors', ('actors',), actor_filters)
+    })
+
+
+app = create_asgi_app()
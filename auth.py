@@ -1,14 +1,23 @@
+import hashlib
 import json
-from flask import request, _request_ctx_stack, Flask, abort, jsonify
+import logging
+import threading
+import time
+from collections import OrderedDict
+from flask import request, _request_ctx_stack, Flask, Response, abort, jsonify
 from functools import wraps
-from jose import jwt
+from jose import jwt, jwk
 from urllib.request import urlopen
-from config import auth_config
+from config import auth_config, jwks_config, token_cache_config
+from metrics import record_auth_time
+from ratelimit import rate_limiter, load_shedder
 
 AUTH0_DOMAIN = auth_config['AUTH0_DOMAIN']
 ALGORITHMS = auth_config['ALGORITHMS']
 API_AUDIENCE = auth_config['API_AUDIENCE']
 
+logger = logging.getLogger(__name__)
+
 # Authorization Error
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -16,18 +25,170 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS key store
+class JWKSKeyStore:
+    # Process wide cache of the signing keys published in the JWKS document.
+    # Each key is parsed once and indexed by kid, as the {'key': prepared key}
+    # mapping that jwt.decode takes without parsing the JWK again. The pinned
+    # python-jose 1.3.2 can't be given a Key object directly, but it rebuilds
+    # one around a prepared key without any parsing. The document is
+    # refreshed after `ttl` seconds, or early when a token carries an unknown
+    # kid (at most once every `min_refetch_interval` seconds). Only one thread
+    # fetches at a time, and the last good keys are kept when a fetch fails.
+    def __init__(self, url, ttl=3600, min_refetch_interval=30, timeout=5):
+        self.url = url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+
+    def get_key(self, kid):
+        key = self._keys.get(kid)
+        if key is not None and not self._expired():
+            return key
+
+        if key is not None:
+            # known kid with expired keys: one thread refreshes while the
+            # others keep verifying with the current key
+            if self._lock.acquire(blocking=False):
+                try:
+                    if self._expired() and self._may_refetch():
+                        self._refresh()
+                finally:
+                    self._lock.release()
+            return self._keys.get(kid, key)
+
+        # unknown kid: wait for whoever is fetching, then check again
+        with self._lock:
+            if kid not in self._keys and self._may_refetch():
+                self._refresh()
+        return self._keys.get(kid)
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+    def _expired(self):
+        return self._fetched_at is None or time.monotonic() - self._fetched_at >= self.ttl
+
+    def _may_refetch(self):
+        return self._last_attempt is None or time.monotonic() - self._last_attempt >= self.min_refetch_interval
+
+    def _refresh(self):
+        self._last_attempt = time.monotonic()
+        try:
+            keys = self._parse(self._fetch())
+        except Exception as e:
+            # keep serving the last good keys
+            logger.warning('could not refresh JWKS from %s: %s', self.url, e)
+            return
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+
+    def _fetch(self):
+        self.fetch_count += 1
+        jsonurl = urlopen(self.url, timeout=self.timeout)
+        return json.loads(jsonurl.read())
+
+    def _parse(self, jwks):
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig' or 'kid' not in key:
+                continue
+            # raises on a key that could not verify anything
+            constructed = jwk.construct(key, key.get('alg', ALGORITHMS[0]))
+            keys[key['kid']] = {'key': constructed.prepared_key}
+        return keys
+
+
+jwks_store = JWKSKeyStore(
+    jwks_config['JWKS_URL'],
+    ttl=jwks_config['JWKS_CACHE_TTL'],
+    min_refetch_interval=jwks_config['JWKS_MIN_REFETCH_INTERVAL'],
+    timeout=jwks_config['JWKS_FETCH_TIMEOUT'])
+
+
+# Verified token cache
+class TokenCache:
+    # Bounded LRU of verified claims keyed by the sha256 of the raw token, so
+    # repeat tokens skip the RS256 signature check. Entries expire at the
+    # token's exp claim. Each entry is (exp, payload, permissions) where
+    # permissions is a frozenset, or None when the claim is missing.
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, token, payload):
+        permissions = payload.get('permissions')
+        if permissions is not None:
+            permissions = frozenset(permissions)
+        entry = (payload.get('exp'), payload, permissions)
+        # tokens without a numeric exp are never cached
+        if self.maxsize <= 0 or not isinstance(entry[0], (int, float)):
+            return entry
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, token):
+        if isinstance(token, str):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).digest()
+
+
+token_cache = TokenCache(token_cache_config['TOKEN_CACHE_SIZE'])
+
+
 # Authorization Header
 def get_token_auth_header():
-    auth_header = request.headers.get('Authorization',None)
-    #it will raise error if authorization is missing in header
-    head_parts = auth_header.split()
+    return parse_auth_header(request.headers.get('Authorization',None))
 
+
+def parse_auth_header(auth_header):
+    # the token from an "Authorization: Bearer <token>" header value
     if not auth_header:
         print('not auth')
         raise AuthError({
             'code': 'authorization header_missing',
             'description': 'Authorizaion header is missing'}, 401)
 
+    head_parts = auth_header.split()
 
     if  head_parts[0].lower() != 'bearer':
         # checking if bearer is present in authorization
@@ -54,15 +215,18 @@ def get_token_auth_header():
     return head_parts[1]
 
 
-def check_permissions(permission, payload):
-    # This functions check the permissions that are in the JWT
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 400)
+def check_permissions(permission, payload, permissions=None):
+    # This functions check the permissions that are in the JWT.
+    # `permissions` is the precomputed frozenset from the token cache.
+    if permissions is None:
+        if 'permissions' not in payload:
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Permissions not included in JWT.'
+            }, 400)
+        permissions = payload['permissions']
 
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -71,27 +235,15 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-
     unverified_header = jwt.get_unverified_header(token)
 
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -127,19 +279,50 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+def get_verified_claims(token):
+    # returns the (exp, payload, permissions) cache entry for the token,
+    # verifying the signature only on a cache miss
+    entry = token_cache.get(token)
+    if entry is None:
+        entry = token_cache.put(token, verify_decode_jwt(token))
+    return entry
+
+
 
 def requires_auth(permissions=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
+            # an overloaded worker turns requests away before verifying them
+            load_shedder.check()
             token = get_token_auth_header()
+            start = time.perf_counter()
             try:
-                payload = verify_decode_jwt(token)
+                exp, payload, granted = get_verified_claims(token)
             except:
                 print('could not verify_decode_jwt')
                 abort(401)
+            finally:
+                record_auth_time(time.perf_counter() - start)
 
-            check_permissions(permissions, payload)
-            return f(payload, *args, **kwargs)
+            # requires_auth() only authenticates, the view checks permissions
+            if permissions:
+                check_permissions(permissions, payload, granted)
+            # requires_auth() views are limited per endpoint
+            rate_limiter.check(payload.get('sub'), permissions or request.endpoint)
+            load_shedder.enter()
+            try:
+                response = f(payload, *args, **kwargs)
+            except BaseException:
+                load_shedder.leave()
+                raise
+            if isinstance(response, Response) and response.is_streamed and not response.direct_passthrough:
+                # A streamed listing is in flight until its body is done. File
+                # downloads pass through without close callbacks and hold no
+                # connection, so they are done here.
+                response.call_on_close(load_shedder.leave)
+            else:
+                load_shedder.leave()
+            return response
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+# Reproducible load test and micro-benchmarks.
+#
+#   python benchmark.py --database sqlite:////tmp/bench.db --sizes 1000,100000 --output bench.json
+#
+# Boots create_app() against the given database, seeds each catalog size,
+# serves it from an in-process threaded server and drives every route at a
+# fixed concurrency. Tokens are signed with a locally generated RSA key and
+# verified against a local JWKS file, so requires_auth runs the real RS256
+# path without Auth0. Results are written as JSON so runs can be compared.
+
+PERMISSIONS = ['get:movies', 'get:actors', 'post:movie', 'post:actor', 'patch:movies',
+               'patch:actors', 'delete:movie', 'delete:actor']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load test and micro-benchmarks for the casting API.')
+    parser.add_argument('--database', default='sqlite:///' + os.path.join(tempfile.gettempdir(), 'capstone_bench.db'),
+                        help='SQLAlchemy URL of a scratch database, it is dropped and recreated')
+    parser.add_argument('--sizes', default='1000,100000',
+                        help='comma separated actor counts to seed, e.g. 1000,100000,1000000')
+    parser.add_argument('--actors-per-movie', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint')
+    parser.add_argument('--no-cache', action='store_true', help='disable the response cache')
+    parser.add_argument('--output', default='bench_output.json')
+    return parser.parse_args(argv)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    # process wide high-water mark, only meaningful once per run. ru_maxrss
+    # is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1)
+
+
+def rss_mb():
+    # current resident set size from /proc (Linux only), None elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return round(pages * resource.getpagesize() / (1024.0 * 1024.0), 1)
+
+
+class Server:
+    # the app on an ephemeral port in a background thread
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+
+def send(url, method, headers, body=None):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    request = Request(url, data=data, method=method, headers=dict(headers, **{'Content-Type': 'application/json'}))
+    start = time.perf_counter()
+    try:
+        with urlopen(request) as response:
+            response.read()
+            status = response.status
+    except HTTPError as e:
+        e.read()
+        status = e.code
+    return time.perf_counter() - start, status
+
+
+def drive(server, headers, name, method, make_request, total, concurrency):
+    # runs `total` requests through `concurrency` workers; make_request(i)
+    # returns the (path, body) of the i-th request
+    requests = [make_request(i) for i in range(total)]
+
+    def run(request):
+        path, body = request
+        return send(server.url + path, method, headers, body)
+
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(run, requests))
+    elapsed = time.perf_counter() - start
+    rss_after = rss_mb()
+
+    latencies = [latency for latency, status in results]
+    statuses = {}
+    for latency, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    result = {
+        'requests': total,
+        'concurrency': concurrency,
+        'throughput_rps': round(total / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'statuses': statuses,
+        # memory the endpoint's requests left resident
+        'rss_mb': rss_after,
+        'rss_delta_mb': round(rss_after - rss_before, 1) if rss_before is not None else None
+    }
+    print('  {:<28} {:>9.1f} req/s  p50 {:>8.2f} ms  p99 {:>8.2f} ms  {}'.format(
+        name, result['throughput_rps'], result['p50_ms'], result['p99_ms'], statuses))
+    return result
+
+
+def seed(models, actors, actors_per_movie):
+    # bulk inserts `actors` actors spread over movies, plus spare movies
+    # without actors for the delete benchmark; returns the id ranges
+    movie_count = max(1, actors // actors_per_movie)
+    movie_ids = []
+    for start in range(0, movie_count, 5000):
+        movie_ids += models.insert_many(models.Movie, [
+            {'title': 'Movie {}'.format(i), 'release_date': date(2000 + i % 20, 1 + i % 12, 1)}
+            for i in range(start, min(movie_count, start + 5000))])
+    actor_ids = []
+    for start in range(0, actors, 5000):
+        actor_ids += models.insert_many(models.Actor, [
+            {'name': 'Actor {}'.format(i), 'age': 18 + i % 60, 'gender': ('female', 'male')[i % 2],
+             'movie_id': movie_ids[i % movie_count]}
+            for i in range(start, min(actors, start + 5000))])
+    spare_movies = models.insert_many(models.Movie, [{'title': 'Spare {}'.format(i)} for i in range(5000)])
+    return movie_ids, actor_ids, spare_movies
+
+
+def run_endpoints(server, headers, ids, args):
+    movie_ids, actor_ids, spare_movies = ids
+    total, concurrency = args.requests, args.concurrency
+    deletable_actors = actor_ids[-total:]
+    deletable_movies = spare_movies[:total]
+    return {
+        'GET /movies': drive(server, headers, 'GET /movies', 'GET',
+                             lambda i: ('/movies?limit=100', None), total, concurrency),
+        'GET /actors': drive(server, headers, 'GET /actors', 'GET',
+                             lambda i: ('/actors?limit=100', None), total, concurrency),
+        'GET /actors?since': drive(server, headers, 'GET /actors?since', 'GET',
+                                   lambda i: ('/actors?since=0&limit=100', None), total, concurrency),
+        'GET /search': drive(server, headers, 'GET /search', 'GET',
+                             lambda i: ('/search?' + urlencode({'q': 'Movie {}'.format(i % 1000)}), None), total, concurrency),
+        'GET /search typo': drive(server, headers, 'GET /search typo', 'GET',
+                                  lambda i: ('/search?' + urlencode({'q': 'Actr {}'.format(i % 1000), 'type': 'actors'}), None),
+                                  total, concurrency),
+        'POST /movies/create': drive(server, headers, 'POST /movies/create', 'POST',
+                                     lambda i: ('/movies/create', {'title': 'Bench {}'.format(i)}),
+                                     total, concurrency),
+        'POST /actors/create': drive(server, headers, 'POST /actors/create', 'POST',
+                                     lambda i: ('/actors/create', {'name': 'Bench {}'.format(i), 'age': 30,
+                                                                   'movie_id': movie_ids[i % len(movie_ids)]}),
+                                     total, concurrency),
+        'PATCH /actors/patch': drive(server, headers, 'PATCH /actors/patch', 'PATCH',
+                                     lambda i: ('/actors/patch/{}'.format(actor_ids[i % len(actor_ids)]),
+                                                {'age': 40}), total, concurrency),
+        'PATCH /movies/patch': drive(server, headers, 'PATCH /movies/patch', 'PATCH',
+                                     lambda i: ('/movies/patch/{}'.format(movie_ids[i % len(movie_ids)]),
+                                                {'title': 'Patched {}'.format(i)}), total, concurrency),
+        'DELETE /actors/delete': drive(server, headers, 'DELETE /actors/delete', 'DELETE',
+                                       lambda i: ('/actors/delete/{}'.format(deletable_actors[i % len(deletable_actors)]),
+                                                  None), total, concurrency),
+        'DELETE /movies/delete': drive(server, headers, 'DELETE /movies/delete', 'DELETE',
+                                       lambda i: ('/movies/delete/{}'.format(deletable_movies[i % len(deletable_movies)]),
+                                                  None), total, concurrency),
+    }
+
+
+def micro_benchmarks(app, signer, number=200):
+    # seconds per call of the hot functions behind every request
+    import auth
+    import models
+    import serializers
+    from flask import jsonify
+
+    def best(stmt, number):
+        return round(min(timeit.repeat(stmt, number=number, repeat=3)) / number * 1e6, 2)
+
+    token = signer.token(PERMISSIONS)
+    results = {'verify_decode_jwt_us': best(lambda: auth.verify_decode_jwt(token), number)}
+    auth.token_cache.clear()
+    auth.get_verified_claims(token)
+    results['get_verified_claims_cached_us'] = best(lambda: auth.get_verified_claims(token), number * 10)
+
+    with app.test_request_context():
+        actors = models.Actor.query.limit(1000).all()
+        movies = models.Movie.query.limit(100).all()
+        formatted = [actor.format() for actor in actors]
+        results['Actor.format_x1000_us'] = best(lambda: [actor.format() for actor in actors], 20)
+        results['Movie.format_x100_us'] = best(lambda: [movie.format() for movie in movies], 20)
+        results['jsonify_1000_actors_us'] = best(lambda: jsonify({'success': True, 'Actors': formatted}), 20)
+
+        # the listing read path before and after the serialization layer:
+        # ORM instances + format() + jsonify against column tuples + dumps
+        def orm_listing():
+            actors = models.Actor.query.order_by(models.Actor.id).limit(1000).all()
+            return jsonify({'success': True, 'Actors': [actor.format() for actor in actors]}).get_data()
+
+        def tuple_listing():
+            rows = models.db.session.query(*models.ACTOR_COLUMNS).order_by(models.Actor.id).limit(1000).all()
+            return serializers.json_response({
+                'success': True, 'Actors': serializers.rows_to_dicts(rows, models.ACTOR_COLUMNS)}).get_data()
+
+        results['json_backend'] = 'orjson' if serializers.orjson is not None else 'json'
+        results['listing_1000_actors_orm_jsonify_us'] = best(orm_listing, 20)
+        results['listing_1000_actors_tuples_dumps_us'] = best(tuple_listing, 20)
+        results['dumps_1000_actors_us'] = best(lambda: serializers.dumps({'success': True, 'Actors': formatted}), 20)
+        results['listing_100_movies_nested_us'] = best(
+            lambda: serializers.dumps(models.movies_with_actors(None, 100)[0]), 20)
+        # one page of GET /search?type=actors: a substring hit and a typo
+        # that only the near-miss stage finds
+        results['search_actors_substring_us'] = best(lambda: models.search(models.Actor, 'Actor 4321'), 20)
+        results['search_actors_typo_us'] = best(lambda: models.search(models.Actor, 'Actr 4321'), 20)
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # the database URL and cache switch are read when the app modules load
+    os.environ['DATABASE_URL'] = args.database
+    if args.no_cache:
+        os.environ['CACHE_ENABLED'] = '0'
+
+    import auth
+    import models
+    from app import create_app
+    from testing import LocalSigner
+
+    tmpdir = tempfile.TemporaryDirectory()
+    signer = LocalSigner()
+    auth.jwks_store.url = signer.write_jwks(os.path.join(tmpdir.name, 'jwks.json'))
+    auth.jwks_store.clear()
+    headers = signer.headers(PERMISSIONS, expires_in=24 * 3600)
+
+    report = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': args.database.split(':')[0], # scheme only, the URL may hold a password
+        'concurrency': args.concurrency,
+        'requests_per_endpoint': args.requests,
+        'response_cache': not args.no_cache,
+        'sizes': {}
+    }
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        print('catalog of {} actors'.format(size))
+        app = create_app()
+        with app.app_context():
+            models.db.drop_all()
+            models.db.create_all()
+            start = time.perf_counter()
+            ids = seed(models, size, args.actors_per_movie)
+            seed_seconds = time.perf_counter() - start
+            models.db.session.remove()
+
+        with Server(app) as server:
+            endpoints = run_endpoints(server, headers, ids, args)
+        report['sizes'][str(size)] = {
+            'seed_seconds': round(seed_seconds, 2),
+            'endpoints': endpoints,
+            'micro': micro_benchmarks(app, signer)
+        }
+
+    report['peak_rss_mb'] = peak_rss_mb()
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to {}'.format(args.output))
+    tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+import csv
+import io
+import json
+import sys
+import time
+from datetime import date
+from itertools import islice
+from sqlalchemy import select, text
+from models import (db, Movie, Actor, bump_version, existing_ids, iter_rows, supports_returning,
+                    MOVIE_COLUMNS, ACTOR_COLUMNS)
+from serializers import dumps
+
+# Streaming import and export of movies and actors as CSV or NDJSON, behind
+# the manage.py import and export commands. Files are read and written
+# `chunk_size` rows at a time, so memory stays flat whatever their size.
+# Postgres loads and dumps with COPY, SQLite with chunked executemany and a
+# server side cursor. Every imported chunk commits on its own with one table
+# version bump, so an interrupted import keeps the chunks before it.
+
+TABLES = {
+    'movies': (Movie, MOVIE_COLUMNS, ('title', 'release_date')),
+    'actors': (Actor, ACTOR_COLUMNS, ('name', 'age', 'gender', 'movie_id'))
+}
+MAX_REPORTED_ERRORS = 100
+
+
+class Progress:
+    # prints rows done and throughput at most every `interval` seconds
+
+    def __init__(self, label, out=sys.stderr, interval=1.0):
+        self.label = label
+        self.out = out
+        self.interval = interval
+        self.rows = 0
+        self.start = self._printed = time.perf_counter()
+
+    def __call__(self, rows):
+        self.rows += rows
+        now = time.perf_counter()
+        if self.out is not None and now - self._printed >= self.interval:
+            self._printed = now
+            self.out.write('{}: {} rows, {:.0f} rows/s\n'.format(self.label, self.rows, self.rate()))
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.start
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return {'rows': self.rows, 'seconds': round(time.perf_counter() - self.start, 2),
+                'rows_per_second': round(self.rate(), 1)}
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    return 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+
+## Import
+
+def read_records(f, fmt):
+    if fmt == 'csv':
+        return csv.DictReader(f)
+    return (json.loads(line) for line in f if line.strip())
+
+
+def coerce(table, record):
+    # CSV gives strings: empty cells become None, numbers and dates are parsed
+    # so the values can go through the same validation as the API
+    record = {key: (None if value == '' else value) for key, value in record.items()}
+    try:
+        if isinstance(record.get('id'), str):
+            record['id'] = int(record['id'])
+        if table == 'movies' and isinstance(record.get('release_date'), str):
+            record['release_date'] = date.fromisoformat(record['release_date'])
+        if table == 'actors':
+            for key in ('age', 'movie_id'):
+                if isinstance(record.get(key), str):
+                    record[key] = int(record[key])
+    except ValueError as e:
+        return None, str(e)
+    return record, None
+
+
+def resolve_movies(items):
+    # Fills in movie_id from movie_title and drops rows whose movie does not
+    # exist, with one query for the titles and one for the ids of the chunk.
+    # `items` is a list of (line, record); returns (items, errors).
+    titles = {record['movie_title'] for line, record in items
+              if record.get('movie_id') is None and record.get('movie_title')}
+    by_title = {}
+    if titles:
+        rows = db.session.execute(select([Movie.id, Movie.title]).where(Movie.title.in_(titles)).order_by(Movie.id))
+        for row in rows:
+            by_title.setdefault(row.title, row.id)
+
+    resolved, errors = [], []
+    for line, record in items:
+        if record.get('movie_id') is None and record.get('movie_title'):
+            if record['movie_title'] not in by_title:
+                errors.append((line, 'movie "{}" not found'.format(record['movie_title'])))
+                continue
+            record['movie_id'] = by_title[record['movie_title']]
+        resolved.append((line, record))
+
+    known = existing_ids(Movie, [record['movie_id'] for line, record in resolved
+                                 if isinstance(record.get('movie_id'), int)])
+    errors += [(line, 'movie {} not found'.format(record['movie_id'])) for line, record in resolved
+               if isinstance(record.get('movie_id'), int) and record['movie_id'] not in known]
+    # rows without a movie are left to the validation
+    return [(line, record) for line, record in resolved
+            if not isinstance(record.get('movie_id'), int) or record['movie_id'] in known], errors
+
+
+def copy_rows(table, columns, rows):
+    # COPY ... FROM STDIN through the session's own connection, so it is part
+    # of the chunk's transaction
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(table, ', '.join(columns)), buffer)
+
+
+def load_chunk(table, rows, keep_ids):
+    model, columns, fields = TABLES[table]
+    fields = ('id',) + fields + ('version',) if keep_ids else fields + ('version',)
+    try:
+        version = bump_version(table)
+        rows = [dict({field: row.get(field) for field in fields}, version=version) for row in rows]
+        if supports_returning():
+            copy_rows(table, fields, rows)
+        else:
+            db.session.execute(model.__table__.insert(), rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def import_records(table, records, validate, chunk_size=5000, keep_ids=False, progress=None):
+    # Loads an iterable of dicts into `table`. `validate` is the API's
+    # validate_movie or validate_actor and returns (values, error). Returns
+    # the row count, throughput and the first invalid lines.
+    progress = progress or Progress('import ' + table)
+    skipped, errors = 0, []
+    records = enumerate(records, start=1)
+    chunk = list(islice(records, chunk_size))
+    while chunk:
+        records_ok, chunk_errors = [], []
+        for line, record in chunk:
+            record, error = coerce(table, record)
+            if error:
+                chunk_errors.append((line, error))
+            else:
+                records_ok.append((line, record))
+        if table == 'actors':
+            records_ok, missing = resolve_movies(records_ok)
+            chunk_errors += missing
+
+        items = []
+        for line, record in records_ok:
+            values, error = validate(record)
+            if error:
+                chunk_errors.append((line, error))
+                continue
+            if keep_ids:
+                values['id'] = record.get('id')
+            items.append(values)
+        if items:
+            load_chunk(table, items, keep_ids)
+
+        skipped += len(chunk_errors)
+        errors += [{'line': line, 'message': message} for line, message in chunk_errors][:MAX_REPORTED_ERRORS - len(errors)]
+        progress(len(items))
+        chunk = list(islice(records, chunk_size))
+
+    if keep_ids and supports_returning():
+        # ids were given explicitly, move the sequence past them
+        db.session.execute(text("SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                                "COALESCE((SELECT MAX(id) FROM {0}), 1))".format(table)))
+        db.session.commit()
+    return dict(progress.summary(), skipped=skipped, errors=errors)
+
+
+def import_file(table, path, validate, fmt=None, chunk_size=5000, keep_ids=False, progress=None):
+    # `path` may be "-" for stdin
+    fmt = detect_format(path, fmt)
+    f = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+    try:
+        return import_records(table, read_records(f, fmt), validate, chunk_size, keep_ids, progress)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+## Export
+
+def export_file(table, path, fmt=None, chunk_size=5000, progress=None):
+    # Writes every row of `table` ordered by id; `path` may be "-" for stdout.
+    # CSV files start with a header row of the column names.
+    model, columns, fields = TABLES[table]
+    fmt = detect_format(path, fmt)
+    progress = progress or Progress('export ' + table)
+    names = [column.key for column in columns]
+    f = sys.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+    try:
+        if fmt == 'csv' and supports_returning():
+            # COPY writes straight into the file, nothing is held in Python
+            counter = CountingWriter(f)
+            cursor = db.session.connection().connection.cursor()
+            cursor.copy_expert('COPY (SELECT {} FROM {} ORDER BY id) TO STDOUT WITH (FORMAT csv, HEADER)'
+                               .format(', '.join(names), table), counter)
+            progress(max(counter.lines - 1, 0))
+        elif fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(names)
+            for rows in chunks(iter_rows(model, columns, chunk_size), chunk_size):
+                writer.writerows(rows)
+                progress(len(rows))
+        else:
+            for rows in chunks(iter_rows(model, columns, chunk_size), chunk_size):
+                f.write(''.join(dumps(dict(zip(names, row))).decode('utf-8') + '\n' for row in rows))
+                progress(len(rows))
+    finally:
+        db.session.commit()
+        if f is not sys.stdout:
+            f.close()
+    return progress.summary()
+
+
+class CountingWriter:
+    # file wrapper counting the lines COPY writes through it
+
+    def __init__(self, f):
+        self.f = f
+        self.lines = 0
+
+    def write(self, data):
+        self.lines += data.count('\n')
+        return self.f.write(data)
+
+
+def chunks(rows, size):
+    rows = iter(rows)
+    chunk = list(islice(rows, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(rows, size))
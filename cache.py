@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, request, g
+
+# Read-through cache for GET responses. Entries hold the serialized body and
+# are keyed on the route, the query parameters and the generation of every
+# table the response depends on. Writes bump the generation of the tables
+# they touch, so stale entries are never looked up again and age out by LRU
+# and TTL.
+
+
+class LocalBackend:
+    # In-process LRU with a TTL per entry. Default backend.
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+class RedisBackend:
+    # Shared between workers. `client` is anything with the redis-py get, set
+    # and incr methods; eviction is left to the server's maxmemory policy.
+    def __init__(self, client=None, url=None, prefix='capstone:'):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def get_counter(self, key):
+        value = self.client.get(self.prefix + key)
+        return int(value) if value is not None else 0
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+
+def make_backend(config):
+    if config['CACHE_BACKEND'] == 'redis':
+        return RedisBackend(url=config['CACHE_URL'])
+    return LocalBackend(config['CACHE_MAX_ENTRIES'])
+
+
+class ResponseCache:
+
+    def __init__(self, backend, ttl=30, enabled=True):
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+
+    def generation(self, table):
+        return self.backend.get_counter('gen:' + table)
+
+    def invalidate(self, *tables):
+        for table in tables:
+            self.backend.incr('gen:' + table)
+
+    def key(self, tables):
+        generations = ','.join('{}:{}'.format(table, self.generation(table)) for table in tables)
+        args = '&'.join('{}={}'.format(k, v) for k, v in sorted(request.args.items(multi=True)))
+        # the ETag set by app.conditional carries the database table versions,
+        # which also catches writes made by other workers
+        return 'response:{}?{}|{}|{}'.format(request.path, args, generations, g.get('etag', ''))
+
+    def cached(self, *tables, unless=None):
+        # Caches successful responses of a GET view. `tables` are the tables
+        # the response is built from; `unless` is a callable that bypasses
+        # the cache for the current request.
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or (unless is not None and unless()):
+                    return f(*args, **kwargs)
+
+                key = self.key(tables)
+                body = self.backend.get(key)
+                if body is not None:
+                    response = Response(body, mimetype='application/json')
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                response = f(*args, **kwargs)
+                if isinstance(response, Response) and response.status_code == 200 \
+                        and not response.is_streamed:
+                    self.backend.set(key, response.get_data(), self.ttl)
+                    response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return decorator
+
+    def invalidates(self, *tables):
+        # Bumps the generation of `tables` after a successful write view.
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                response = f(*args, **kwargs)
+                status = response[1] if isinstance(response, tuple) else response.status_code
+                if status < 400:
+                    self.invalidate(*tables)
+                return response
+            return wrapper
+        return decorator
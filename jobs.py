@@ -0,0 +1,172 @@
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from flask import _app_ctx_stack, json
+from sqlalchemy import create_engine
+from bulk import Progress
+from models import engine_options
+from serializers import dumps
+
+# Background jobs for work that outlives a request timeout: file imports,
+# full exports and cascading deletes. A view submits a function and answers
+# 202 with the job id. The function runs on a bounded thread pool in an app
+# context. Its session is bound to a small dedicated engine, one connection
+# per worker, so running jobs never take connections from the pool serving
+# requests. Job state is kept in a cache backend (local to the process, or
+# redis shared between workers) and polled on GET /jobs/<id>.
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def utcnow():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class JobProgress(Progress):
+    # bulk.Progress that saves rows done and throughput on the job record at
+    # most every `interval` seconds
+
+    def __init__(self, runner, job_id, interval=1.0):
+        super().__init__(job_id, out=None, interval=interval)
+        self.runner = runner
+        self.job_id = job_id
+        self._saved = self.start
+
+    def __call__(self, rows):
+        super().__call__(rows)
+        now = time.perf_counter()
+        if now - self._saved >= self.interval:
+            self._saved = now
+            self.runner.update(self.job_id, **self.summary())
+
+
+class JobRunner:
+
+    def __init__(self, app, store, workers=2, max_queued=8, ttl=86400, directory=None):
+        # `store` is a cache backend (cache.LocalBackend or RedisBackend).
+        # At most `workers` jobs run at once and `max_queued` more wait;
+        # submit raises JobQueueFull beyond that.
+        self.app = app
+        self.store = store
+        self.workers = workers
+        self.ttl = ttl
+        self.directory = directory or tempfile.gettempdir()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._slots = threading.BoundedSemaphore(workers + max_queued)
+        self._futures = {}
+        self._engine = None
+        self._lock = threading.Lock()
+        self._swept = 0
+        self.sweep()
+
+    @property
+    def engine(self):
+        # created on the first job, the app may never run one
+        with self._lock:
+            if self._engine is None:
+                url = self.app.config['SQLALCHEMY_DATABASE_URI']
+                options = engine_options(url)
+                if options:
+                    options.update(pool_size=self.workers, max_overflow=0)
+                self._engine = create_engine(url, **options)
+            return self._engine
+
+    def path(self, job_id, suffix):
+        # file a job reads from or writes to, e.g. an upload or an export
+        return os.path.join(self.directory, 'job-{}.{}'.format(job_id, suffix))
+
+    def sweep(self):
+        # Removes job files older than the record TTL, nothing can download
+        # them once their record has expired. Runs at start and at most once
+        # a minute on submit.
+        self._swept = time.monotonic()
+        cutoff = time.time() - self.ttl
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in entries:
+            if not entry.name.startswith('job-'):
+                continue
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass  # removed by another worker
+
+    ## Job records
+
+    def get(self, job_id):
+        value = self.store.get('job:' + job_id)
+        return json.loads(value) if value is not None else None
+
+    def save(self, record):
+        self.store.set('job:' + record['id'], dumps(record), self.ttl)
+
+    def update(self, job_id, **fields):
+        # only the job's own thread writes after submit, no lost updates
+        record = self.get(job_id)
+        if record is not None:
+            record.update(fields)
+            self.save(record)
+        return record
+
+    ## Running
+
+    def submit(self, kind, owner, f, *args, **kwargs):
+        # Queues f(progress, *args, **kwargs), whose return value becomes the
+        # job's JSON result. `owner` is the JWT sub allowed to read the job.
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull()
+        if time.monotonic() - self._swept >= 60:
+            self.sweep()
+        job_id = uuid.uuid4().hex
+        record = {'id': job_id, 'kind': kind, 'owner': owner, 'status': 'queued', 'created_at': utcnow(),
+                  'started_at': None, 'finished_at': None, 'rows': 0, 'seconds': 0, 'rows_per_second': 0,
+                  'result': None, 'error': None}
+        self.save(record)
+        try:
+            future = self.executor.submit(self._run, job_id, f, args, kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        self._futures[job_id] = future
+        future.add_done_callback(lambda _: self._futures.pop(job_id, None))
+        return record
+
+    def _run(self, job_id, f, args, kwargs):
+        try:
+            with self.app.app_context():
+                # picked up by RoutingSession.get_bind
+                _app_ctx_stack.top.job_engine = self.engine
+                self.update(job_id, status='running', started_at=utcnow())
+                progress = JobProgress(self, job_id)
+                try:
+                    result = f(progress, *args, **kwargs)
+                except Exception as e:
+                    self.app.logger.exception('job %s failed', job_id)
+                    self.update(job_id, status='failed', error=str(e) or type(e).__name__,
+                                finished_at=utcnow(), **progress.summary())
+                else:
+                    self.update(job_id, status='succeeded', result=result, finished_at=utcnow(),
+                                **progress.summary())
+        finally:
+            self._slots.release()
+
+    def wait(self, job_id, timeout=None):
+        # blocks until a job submitted by this process is done, for tests
+        future = self._futures.get(job_id)
+        if future is not None:
+            future.exception(timeout)
+        return self.get(job_id)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        if self._engine is not None:
+            self._engine.dispose()
@@ -1,15 +1,56 @@
-from flask_script import Manager
+import json
+import sys
+from flask_script import Manager, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
+from app import app, validate_movie, validate_actor
 from models import db
+from bulk import import_file, export_file
 
 # creating Migarte and Manager object instances
- 
+
 migrate = Migrate(app, db)
 manager = Manager(app)
 
+VALIDATORS = {'movies': validate_movie, 'actors': validate_actor}
+
+
+class Import(Command):
+    "Load movies or actors from a CSV or NDJSON file"
+
+    option_list = (
+        Option('table', choices=sorted(VALIDATORS)),
+        Option('path', help='file to read, - for stdin'),
+        Option('--format', dest='fmt', choices=('csv', 'ndjson'), help='default: from the file extension'),
+        Option('--chunk-size', type=int, default=5000, help='rows per transaction'),
+        Option('--keep-ids', action='store_true', help='insert the id column instead of new ids'),
+    )
+
+    def run(self, table, path, fmt, chunk_size, keep_ids):
+        # actors reference their movie by movie_id or by movie_title
+        result = import_file(table, path, VALIDATORS[table], fmt, chunk_size, keep_ids)
+        print(json.dumps(result, indent=2))
+
+
+class Export(Command):
+    "Write every movie or actor to a CSV or NDJSON file"
+
+    option_list = (
+        Option('table', choices=sorted(VALIDATORS)),
+        Option('path', help='file to write, - for stdout'),
+        Option('--format', dest='fmt', choices=('csv', 'ndjson'), help='default: from the file extension'),
+        Option('--chunk-size', type=int, default=5000, help='rows per fetch'),
+    )
+
+    def run(self, table, path, fmt, chunk_size):
+        # the summary goes to stderr, the rows may be going to stdout
+        result = export_file(table, path, fmt, chunk_size)
+        print(json.dumps(result, indent=2), file=sys.stderr)
+
+
 manager.add_command('db', MigrateCommand)
+manager.add_command('import', Import())
+manager.add_command('export', Export())
 
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
@@ -0,0 +1,182 @@
+import bisect
+import threading
+import time
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Request instrumentation exported on /metrics in the Prometheus text format:
+# per route latency, time spent verifying JWTs and in the database, SQL
+# statements and rows per request and connection pool checkout wait and
+# saturation. Recording is a few dict updates under a lock per request.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500, 1000, 10000)
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((labels, [list(s[0]), s[1], s[2]]) for labels, s in self._series.items())
+        for label_values, (counts, total, count) in series:
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labels + ('le',), label_values + (bound,)), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, labels, total))
+            lines.append('{}_count{} {}'.format(self.name, labels, count))
+        return lines
+
+
+class Gauge:
+    # values read at scrape time from one function per label values
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._functions = {}
+
+    def set_function(self, function, *label_values):
+        self._functions[label_values] = function
+
+    def render(self):
+        samples = []
+        for label_values, function in sorted(self._functions.items()):
+            value = function()
+            if value is not None:
+                samples.append('{}{} {}'.format(self.name, _labels(self.labels, label_values), value))
+        if not samples:
+            return []
+        return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} gauge'.format(self.name)] + samples
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+request_latency = Histogram('http_request_duration_seconds', 'Time spent handling a request.',
+                            ('endpoint', 'method', 'status'))
+auth_latency = Histogram('auth_verification_seconds', 'Time spent verifying the bearer token in requires_auth.',
+                         ('endpoint',))
+db_latency = Histogram('db_time_seconds', 'Time spent executing SQL statements per request.', ('endpoint',))
+db_statements = Histogram('db_statements_per_request', 'SQL statements issued per request.', ('endpoint',),
+                          COUNT_BUCKETS)
+db_rows = Histogram('db_rows_per_request', 'Rows returned or affected by SQL statements per request.',
+                    ('endpoint',), COUNT_BUCKETS)
+pool_wait = Histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection.', ('pool',))
+pool_checked_out = Gauge('db_pool_checked_out', 'Connections currently checked out of the pool.', ('pool',))
+pool_size = Gauge('db_pool_size', 'Configured size of the pool.', ('pool',))
+pool_overflow = Gauge('db_pool_overflow', 'Overflow connections open in the pool.', ('pool',))
+
+registry = [request_latency, auth_latency, db_latency, db_statements, db_rows, pool_wait, pool_checked_out,
+            pool_size, pool_overflow]
+
+
+def record_auth_time(seconds):
+    # called by requires_auth; kept per request and observed at the end
+    if has_request_context() and 'metrics' in g:
+        g.metrics['auth'] += seconds
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+## Database instrumentation
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['metrics_start'].pop()
+    if has_request_context() and 'metrics' in g:
+        state = g.metrics
+        state['statements'] += 1
+        state['db'] += elapsed
+        if cursor.rowcount and cursor.rowcount > 0:
+            state['rows'] += cursor.rowcount
+
+
+def instrument_pool(engine, name='primary'):
+    # Times connection checkouts by wrapping the pool's internal _do_get, the
+    # only place a checkout waits for a free connection, and exports the pool
+    # saturation as gauges.
+    pool = engine.pool
+    do_get = pool._do_get
+
+    def timed_do_get():
+        start = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            pool_wait.observe(time.perf_counter() - start, name)
+
+    pool._do_get = timed_do_get
+    if hasattr(pool, 'checkedout'):
+        pool_checked_out.set_function(pool.checkedout, name)
+        pool_size.set_function(pool.size, name)
+        pool_overflow.set_function(pool.overflow, name)
+
+
+## Flask integration
+
+def init_metrics(app, db):
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    with app.app_context():
+        instrument_pool(db.engine)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics = {'start': time.perf_counter(), 'auth': 0.0, 'db': 0.0, 'statements': 0, 'rows': 0}
+
+    @app.after_request
+    def record_request_metrics(response):
+        # streamed bodies are timed until the first byte
+        state = g.pop('metrics', None)
+        if state is None:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        request_latency.observe(time.perf_counter() - state['start'], endpoint, request.method,
+                                response.status_code)
+        if state['auth']:
+            auth_latency.observe(state['auth'], endpoint)
+        db_latency.observe(state['db'], endpoint)
+        db_statements.observe(state['statements'], endpoint)
+        db_rows.observe(state['rows'], endpoint)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render(), mimetype='text/plain; version=0.0.4')
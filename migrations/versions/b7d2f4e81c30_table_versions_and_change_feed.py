@@ -0,0 +1,51 @@
+"""table versions, row versions and tombstones for ETags and the change feed
+
+Revision ID: b7d2f4e81c30
+Revises: a1c3e5f70b12
+Create Date: 2026-10-18 09:14:51.602477
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2f4e81c30'
+down_revision = 'a1c3e5f70b12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('table_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [{'name': 'movies', 'version': 0}, {'name': 'actors', 'version': 0}])
+
+    op.create_table('tombstones',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_tombstones_table_name_version', 'tombstones', ['table_name', 'version'], unique=False)
+
+    op.add_column('movies', sa.Column('version', sa.BigInteger(), server_default='0', nullable=False))
+    op.add_column('actors', sa.Column('version', sa.BigInteger(), server_default='0', nullable=False))
+    op.create_index('ix_movies_version_id', 'movies', ['version', 'id'], unique=False)
+    op.create_index('ix_actors_version_id', 'actors', ['version', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_actors_version_id', table_name='actors')
+    op.drop_index('ix_movies_version_id', table_name='movies')
+    with op.batch_alter_table('actors') as batch_op:
+        batch_op.drop_column('version')
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.drop_column('version')
+    op.drop_index('ix_tombstones_table_name_version', table_name='tombstones')
+    op.drop_table('tombstones')
+    op.drop_table('table_versions')
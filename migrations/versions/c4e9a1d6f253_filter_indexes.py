@@ -0,0 +1,32 @@
+"""indexes for the listing filters
+
+Revision ID: c4e9a1d6f253
+Revises: b7d2f4e81c30
+Create Date: 2026-10-18 09:20:37.884090
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e9a1d6f253'
+down_revision = 'b7d2f4e81c30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # (movie_id, id) serves both the join on the foreign key and
+    # ?movie_id= pages ordered by id
+    op.create_index('ix_actors_movie_id_id', 'actors', ['movie_id', 'id'], unique=False)
+    op.create_index('ix_actors_gender_age', 'actors', ['gender', 'age'], unique=False)
+    op.create_index('ix_actors_age', 'actors', ['age'], unique=False)
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_actors_age', table_name='actors')
+    op.drop_index('ix_actors_gender_age', table_name='actors')
+    op.drop_index('ix_actors_movie_id_id', table_name='actors')
@@ -0,0 +1,61 @@
+"""text search indexes on movie titles and actor names
+
+Revision ID: d8a2c6b4f017
+Revises: c4e9a1d6f253
+Create Date: 2026-10-18 10:02:13.517264
+
+"""
+import sqlite3
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8a2c6b4f017'
+down_revision = 'c4e9a1d6f253'
+branch_labels = None
+depends_on = None
+
+SEARCH_COLUMNS = (('movies', 'title'), ('actors', 'name'))
+
+
+def fts_ddl(table, column):
+    # external content FTS5 table with the trigram tokenizer, kept in sync
+    # by triggers; same statements as models.fts_ddl
+    fts = table + '_fts'
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {2} USING fts5({1}, content='{0}', content_rowid='id', "
+        "tokenize='trigram')".format(table, column, fts),
+        "CREATE TRIGGER IF NOT EXISTS {2}_insert AFTER INSERT ON {0} BEGIN "
+        "INSERT INTO {2}(rowid, {1}) VALUES (new.id, new.{1}); END".format(table, column, fts),
+        "CREATE TRIGGER IF NOT EXISTS {2}_delete AFTER DELETE ON {0} BEGIN "
+        "INSERT INTO {2}({2}, rowid, {1}) VALUES ('delete', old.id, old.{1}); END".format(table, column, fts),
+        "CREATE TRIGGER IF NOT EXISTS {2}_update AFTER UPDATE OF {1} ON {0} BEGIN "
+        "INSERT INTO {2}({2}, rowid, {1}) VALUES ('delete', old.id, old.{1}); "
+        "INSERT INTO {2}(rowid, {1}) VALUES (new.id, new.{1}); END".format(table, column, fts),
+        # index the rows that are already there
+        "INSERT INTO {0}({0}) VALUES ('rebuild')".format(fts),
+    ]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table, column in SEARCH_COLUMNS:
+            op.execute('CREATE INDEX ix_{0}_{1}_trgm ON {0} USING gin ({1} gin_trgm_ops)'.format(table, column))
+    elif dialect == 'sqlite' and sqlite3.sqlite_version_info >= (3, 34, 0):
+        for table, column in SEARCH_COLUMNS:
+            for statement in fts_ddl(table, column):
+                op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in SEARCH_COLUMNS:
+        if dialect == 'postgresql':
+            op.execute('DROP INDEX IF EXISTS ix_{0}_{1}_trgm'.format(table, column))
+        elif dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute('DROP TRIGGER IF EXISTS {}_fts_{}'.format(table, trigger))
+            op.execute('DROP TABLE IF EXISTS {}_fts'.format(table))
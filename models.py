@@ -1,19 +1,390 @@
 import os
-from sqlalchemy import Column, String, Integer
+import sqlite3
+from sqlalchemy import Column, String, Integer, select, event, func, tuple_, or_, text
 from flask_sqlalchemy import SQLAlchemy
+from replicas import RoutingSQLAlchemy
 import json
-import config import database_setup
+from config import database_setup, pool_config
 
-data_path = os.environ.get('DATABASE_URL', "postgres://{}:{}@{}/{}".format(database_setup["user_name"], database_setup["password"], database_setup["port"], database_setup["database_name_test"]))
+def sqlalchemy_url(url):
+    # SQLAlchemy 1.4 dropped the postgres:// alias that Heroku still sets
+    if url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+database_path = sqlalchemy_url(os.environ.get('DATABASE_URL', "postgresql://{}:{}@{}/{}".format(database_setup["user_name"], database_setup["password"], database_setup["port"], database_setup["database_name_test"])))
+
+db = RoutingSQLAlchemy()
+
+def engine_options(url):
+    # pool settings from pool_config; SQLite keeps SQLAlchemy's defaults
+    if url.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': pool_config['DB_POOL_SIZE'],
+        'max_overflow': pool_config['DB_MAX_OVERFLOW'],
+        'pool_timeout': pool_config['DB_POOL_TIMEOUT'],
+        'pool_recycle': pool_config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': pool_config['DB_POOL_PRE_PING']
+    }
 
-db = SQLAlchemy()
 
 def setup_db(app):
+    # the schema is created by the migrations (python manage.py db upgrade)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(database_path))
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+
+def keyset_page(model, after_id=None, limit=100, columns=None, filters=()):
+    # Keyset pagination on the primary key: a single range scan on the id
+    # index. One extra row is fetched to tell whether a next page exists.
+    # With `columns` the page is read as plain column tuples.
+    query = db.session.query(*columns) if columns else model.query
+    query = query.filter(*filters).order_by(model.id)
+    if after_id is not None:
+        query = query.filter(model.id > after_id)
+    rows = query.limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+
+def movies_with_actors(after_id=None, limit=100, filters=(), columns=None, expand=True):
+    # A page of formatted movies with their actors nested, in two statements
+    # whatever the page size: the movie page and one grouped actor query.
+    # `columns` narrows the movie columns read; expand=False skips the actors.
+    columns = columns or MOVIE_COLUMNS
+    movies, has_more = keyset_page(Movie, after_id, limit, columns, filters)
+    return nest_actors(movies, columns, expand), has_more
+
+
+def nest_actors(movies, columns=None, expand=True):
+    keys = [column.key for column in columns or MOVIE_COLUMNS]
+    items = [dict(zip(keys, movie)) for movie in movies]
+    if expand:
+        actors = actors_by_movie([item['id'] for item in items])
+        for item in items:
+            item['actors'] = actors[item['id']]
+    return items
+
+
+def iter_rows(model, columns, chunk_size=1000, filters=()):
+    # Streams column tuples ordered by id through a server side cursor,
+    # holding at most `chunk_size` rows in memory.
+    return iter(db.session.query(*columns).filter(*filters).order_by(model.id)
+                .execution_options(stream_results=True).yield_per(chunk_size))
+
+
+def iter_actors(chunk_size=1000, filters=(), columns=None):
+    columns = columns or ACTOR_COLUMNS
+    keys = [column.key for column in columns]
+    for row in iter_rows(Actor, columns, chunk_size, filters):
+        yield dict(zip(keys, row))
+
+
+def iter_movies_with_actors(chunk_size=1000, filters=(), columns=None, expand=True):
+    # streams movies with nested actors, one grouped actor query per chunk
+    columns = columns or MOVIE_COLUMNS
+    batch = []
+    for movie in iter_rows(Movie, columns, chunk_size, filters):
+        batch.append(movie)
+        if len(batch) == chunk_size:
+            yield from nest_actors(batch, columns, expand)
+            batch = []
+    if batch:
+        yield from nest_actors(batch, columns, expand)
+
+
+def actors_by_movie(movie_ids):
+    # formatted actors grouped by movie id, read with a single IN query
+    grouped = {movie_id: [] for movie_id in movie_ids}
+    if not movie_ids:
+        return grouped
+    rows = db.session.query(*ACTOR_COLUMNS).filter(
+        Actor.movie_id.in_(movie_ids)).order_by(Actor.movie_id, Actor.id)
+    for row in rows:
+        grouped[row.movie_id].append({
+            'id': row.id,
+            'name': row.name,
+            'age': row.age,
+            'gender': row.gender,
+            'movie_id': row.movie_id
+        })
+    return grouped
+
+
+def supports_returning():
+    # INSERT/UPDATE/DELETE ... RETURNING is only used on postgres
+    return db.engine.dialect.name == 'postgresql'
+
+
+def insert_many(model, rows, chunk_size=1000):
+    # Inserts `rows` (dicts of column values) in a single transaction and
+    # returns the new ids in the same order. Postgres gets multi row
+    # INSERT ... RETURNING statements, SQLite a single executemany.
+    table = model.__table__
+    ids = []
+    try:
+        version = bump_version(table.name)
+        rows = [dict(row, version=version) for row in rows]
+        if supports_returning():
+            for start in range(0, len(rows), chunk_size):
+                result = db.session.execute(
+                    table.insert().values(rows[start:start + chunk_size]).returning(table.c.id))
+                ids.extend(row[0] for row in result)
+        else:
+            # SQLite hands out consecutive rowids inside the write transaction,
+            # so one executemany and a max(id) give back every id
+            db.session.execute(table.insert(), rows)
+            last = db.session.execute(select([func.max(table.c.id)])).scalar()
+            ids = list(range(last - len(rows) + 1, last + 1))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+def insert_returning(model, values, columns, commit=True):
+    # Inserts one row and returns the given columns as a dict in a single
+    # INSERT ... RETURNING on postgres. Elsewhere the row is assembled from
+    # the inserted values and the new primary key, without reading it back.
+    # With commit=False the write joins the caller's transaction, which the
+    # caller commits or rolls back (also for the helpers below).
+    table = model.__table__
+    try:
+        values = dict(values, version=bump_version(table.name))
+        if supports_returning():
+            row = dict(db.session.execute(
+                table.insert().values(**values).returning(*_table_columns(table, columns))).first())
+        else:
+            result = db.session.execute(table.insert().values(**values))
+            row = {column.key: values.get(column.key) for column in columns}
+            row['id'] = result.inserted_primary_key[0]
+        if commit:
+            db.session.commit()
+    except Exception:
+        if commit:
+            db.session.rollback()
+        raise
+    return row
+
+
+def update_returning(model, id, values, columns, commit=True):
+    # UPDATE ... WHERE id = :id RETURNING the given columns; returns None when
+    # no row matched. Without RETURNING the row is read back after the update.
+    table = model.__table__
+    try:
+        statement = table.update().where(table.c.id == id).values(version=bump_version(table.name), **values)
+        if supports_returning():
+            row = db.session.execute(statement.returning(*_table_columns(table, columns))).first()
+        else:
+            row = None
+            if db.session.execute(statement).rowcount:
+                row = db.session.execute(
+                    select(_table_columns(table, columns)).where(table.c.id == id)).first()
+        finish(row is not None, commit)
+    except Exception:
+        if commit:
+            db.session.rollback()
+        raise
+    return dict(row) if row else None
+
+
+def delete_returning(model, id, commit=True):
+    # DELETE ... WHERE id = :id RETURNING id; returns whether a row was deleted.
+    # A tombstone records the delete for the change feed.
+    table = model.__table__
+    statement = table.delete().where(table.c.id == id)
+    try:
+        version = bump_version(table.name)
+        if supports_returning():
+            deleted = db.session.execute(statement.returning(table.c.id)).first() is not None
+        else:
+            deleted = db.session.execute(statement).rowcount > 0
+        if deleted:
+            add_tombstones(table.name, [id], version)
+        finish(deleted, commit)
+    except Exception:
+        if commit:
+            db.session.rollback()
+        raise
+    return deleted
+
+
+def delete_movie_cascade(movie_id, mode, to=None, chunk_size=1000, progress=None):
+    # Deletes (mode "delete") or moves to movie `to` (mode "reassign") the
+    # actors of movie `movie_id`, then deletes the movie. Actors are handled
+    # with set based statements, `chunk_size` per transaction, so no lock is
+    # held for long; every chunk bumps the actors version and deleted actors
+    # get tombstones. Returns (movie deleted, actors affected).
+    table = Actor.__table__
+    affected = 0
+    while True:
+        try:
+            ids = [row[0] for row in db.session.execute(select([table.c.id]).where(
+                table.c.movie_id == movie_id).order_by(table.c.id).limit(chunk_size))]
+            if not ids:
+                db.session.rollback()
+                break
+            version = bump_version(table.name)
+            chunk = table.c.id.in_(ids) & (table.c.movie_id == movie_id)
+            if mode == 'delete':
+                db.session.execute(table.delete().where(chunk))
+                add_tombstones(table.name, ids, version)
+            else:
+                db.session.execute(table.update().where(chunk).values(movie_id=to, version=version))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        affected += len(ids)
+        if progress is not None:
+            progress(len(ids))
+    return delete_returning(Movie, movie_id), affected
+
+
+def finish(changed, commit=True):
+    # commits when the statement matched a row, otherwise rolls back so the
+    # version bump is undone as well
+    if not commit:
+        return
+    if changed:
+        db.session.commit()
+    else:
+        db.session.rollback()
+
+
+def bump_version(name):
+    # Increments the version of table `name` inside the current transaction and
+    # returns it. The row stays locked until commit, so concurrent writers to
+    # the same table are serialized and their versions commit in order.
+    # changes_since relies on that: everything up to the current version is
+    # committed, so a feed cursor never skips a slower writer's rows. A
+    # sequence or max(version) would remove the hot row but break that
+    # guarantee. Writes therefore take one bump per transaction (a bulk
+    # create, a batch, an import or cascade chunk) and keep it short.
+    table = TableVersion.__table__
+    statement = table.update().where(table.c.name == name).values(version=table.c.version + 1)
+    if supports_returning():
+        row = db.session.execute(statement.returning(table.c.version)).first()
+    else:
+        row = None
+        if db.session.execute(statement).rowcount:
+            row = db.session.execute(select([table.c.version]).where(table.c.name == name)).first()
+    if row is None:
+        db.session.execute(table.insert().values(name=name, version=1))
+        return 1
+    return row[0]
+
+
+# Transactions writing to several tables lock their version rows in this
+# order before anything else, so two of them never wait on each other.
+VERSION_LOCK_ORDER = ('movies', 'actors')
+
+
+def lock_versions(names):
+    # Row locks on the versions of `names`, taken up front in
+    # VERSION_LOCK_ORDER; the bump_version calls that follow in the same
+    # transaction already hold them. SQLite locks the whole database anyway.
+    table = TableVersion.__table__
+    for name in sorted(set(names), key=VERSION_LOCK_ORDER.index):
+        db.session.execute(select([table.c.version]).where(table.c.name == name).with_for_update())
+
+
+def add_tombstones(name, ids, version):
+    if ids:
+        db.session.execute(Tombstone.__table__.insert(),
+                           [{'table_name': name, 'row_id': id, 'version': version} for id in ids])
+
+
+def changes_since(model, columns, since_version, after_id=None, limit=100, after_deleted_id=None):
+    # Change feed: rows of `model` written after the (version, id) cursor in
+    # (version, id) order on the version index, plus at most `limit` ids
+    # deleted after the (version, tombstone id) cursor. `after_id` and
+    # `after_deleted_id` None mean everything of `since_version` was already
+    # seen. Returns (rows, deleted_ids, next_version, next_id, next_deleted_id,
+    # has_more).
+    name = model.__tablename__
+    # every version up to `committed` is committed, later ones are left for the next call
+    committed = upper = current_versions([name])[name]
+    if after_id is None:
+        after = model.version > since_version
+    else:
+        after = tuple_(model.version, model.id) > tuple_(since_version, after_id)
+    rows = db.session.query(*columns, model.version).filter(after, model.version <= upper) \
+        .order_by(model.version, model.id).limit(limit + 1).all()
+
+    tombstones = Tombstone.__table__
+    if after_deleted_id is None:
+        after_deleted = tombstones.c.version > since_version
+    else:
+        after_deleted = tuple_(tombstones.c.version, tombstones.c.id) > tuple_(since_version, after_deleted_id)
+    deleted = db.session.execute(select([tombstones.c.id, tombstones.c.row_id, tombstones.c.version]).where(
+        (tombstones.c.table_name == name) & after_deleted & (tombstones.c.version <= upper))
+        .order_by(tombstones.c.version, tombstones.c.id).limit(limit + 1)).fetchall()
+
+    # the page ends at the lowest version where rows or tombstones were cut
+    # off; only that side resumes inside the version
+    rows_upper = deleted_upper = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        upper = rows_upper = rows[-1].version
+    if len(deleted) > limit:
+        deleted = deleted[:limit]
+        deleted_upper = deleted[-1].version
+        upper = min(upper, deleted_upper)
+    rows = [row for row in rows if row.version <= upper]
+    deleted = [row for row in deleted if row.version <= upper]
+    next_id = rows[-1].id if rows_upper == upper else None
+    next_deleted_id = deleted[-1].id if deleted_upper == upper else None
+    has_more = upper < committed or next_id is not None or next_deleted_id is not None
+    return rows, [row.row_id for row in deleted], upper, next_id, next_deleted_id, has_more
+
+
+def current_versions(names):
+    # {table name: version} for `names`, in one primary key lookup
+    table = TableVersion.__table__
+    rows = db.session.execute(select([table.c.name, table.c.version]).where(table.c.name.in_(names)))
+    versions = {name: 0 for name in names}
+    versions.update((row.name, row.version) for row in rows)
+    return versions
+
+
+def _table_columns(table, columns):
+    return [table.c[column.key] for column in columns]
+
+
+def existing_ids(model, ids):
+    # the subset of `ids` present in the table, in one query
+    if not ids:
+        return set()
+    return {row[0] for row in db.session.query(model.id).filter(model.id.in_(set(ids)))}
+
+
+class TableVersion(db.Model):
+    # one row per table, bumped in the same transaction as every write to it.
+    # Used for ETags on the listing endpoints.
+    __tablename__ = 'table_versions'
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class Tombstone(db.Model):
+    # deleted rows, kept so change feed consumers can mirror deletes
+    __tablename__ = 'tombstones'
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String, nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.BigInteger, nullable=False)
+    __table_args__ = (db.Index('ix_tombstones_table_name_version', 'table_name', 'version'),)
+
+
+@event.listens_for(TableVersion.__table__, 'after_create')
+def seed_table_versions(target, connection, **kw):
+    connection.execute(target.insert(), [{'name': 'movies', 'version': 0}, {'name': 'actors', 'version': 0}])
 
 
 class Movie(db.Model):
@@ -22,24 +393,34 @@ class Movie(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String)
     release_date = db.Column(db.Date)
-    actors = db.relationship('Actor', backref='movies')
+    # version of the movies table at this row's last write, for the change feed
+    version = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    # the database keeps actors from losing their movie, see delete_movie_cascade
+    actors = db.relationship('Actor', backref='movies', lazy='selectin', passive_deletes=True)
+    __table_args__ = (
+        db.Index('ix_movies_version_id', 'version', 'id'),
+        db.Index('ix_movies_release_date', 'release_date'),
+    )
 
     def format(self):
         return{
             'id': self.id,
             'title': self.title,
             'release_date': self.release_date,
-            'actors': self.actors        
+            'actors': [actor.format() for actor in self.actors]
         }
     
     def insert(self):
+        self.version = bump_version(self.__tablename__)
         db.session.add(self)
         db.session.commit()
     
     def update(self):
+        self.version = bump_version(self.__tablename__)
         db.session.commit()
 
     def delete(self):
+        add_tombstones(self.__tablename__, [self.id], bump_version(self.__tablename__))
         db.session.delete(self)
         db.session.commit()
 
@@ -51,6 +432,14 @@ class Actor(db.Model):
     age = db.Column(db.Integer)
     gender = db.Column(db.String)
     movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), nullable=False)
+    version = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    __table_args__ = (
+        db.Index('ix_actors_version_id', 'version', 'id'),
+        # the foreign key everything joins on, with id for ?movie_id= pages
+        db.Index('ix_actors_movie_id_id', 'movie_id', 'id'),
+        db.Index('ix_actors_gender_age', 'gender', 'age'),
+        db.Index('ix_actors_age', 'age'),
+    )
 
     def format(self):
         return {
@@ -61,12 +450,159 @@ class Actor(db.Model):
             'movie_id': self.movie_id
         }
     def insert(self):
+        self.version = bump_version(self.__tablename__)
         db.session.add(self)
         db.session.commit()
     
     def update(self):
+        self.version = bump_version(self.__tablename__)
         db.session.commit()
 
     def delete(self):
+        add_tombstones(self.__tablename__, [self.id], bump_version(self.__tablename__))
         db.session.delete(self)
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+
+
+MOVIE_COLUMNS = (Movie.id, Movie.title, Movie.release_date)
+ACTOR_COLUMNS = (Actor.id, Actor.name, Actor.age, Actor.gender, Actor.movie_id)
+
+
+## Search
+# Movie titles and actor names are indexed for prefix, substring and typo
+# tolerant lookups: a pg_trgm GIN index on postgres, an FTS5 trigram table
+# kept in sync by triggers on SQLite. migrations/ creates the same objects.
+
+SEARCH_COLUMNS = {'movies': 'title', 'actors': 'name'}
+
+
+def has_trigram_fts():
+    # the FTS5 trigram tokenizer ships with SQLite 3.34
+    return sqlite3.sqlite_version_info >= (3, 34, 0)
+
+
+def fts_ddl(table, column):
+    fts = table + '_fts'
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {2} USING fts5({1}, content='{0}', content_rowid='id', "
+        "tokenize='trigram')".format(table, column, fts),
+        "CREATE TRIGGER IF NOT EXISTS {2}_insert AFTER INSERT ON {0} BEGIN "
+        "INSERT INTO {2}(rowid, {1}) VALUES (new.id, new.{1}); END".format(table, column, fts),
+        "CREATE TRIGGER IF NOT EXISTS {2}_delete AFTER DELETE ON {0} BEGIN "
+        "INSERT INTO {2}({2}, rowid, {1}) VALUES ('delete', old.id, old.{1}); END".format(table, column, fts),
+        "CREATE TRIGGER IF NOT EXISTS {2}_update AFTER UPDATE OF {1} ON {0} BEGIN "
+        "INSERT INTO {2}({2}, rowid, {1}) VALUES ('delete', old.id, old.{1}); "
+        "INSERT INTO {2}(rowid, {1}) VALUES (new.id, new.{1}); END".format(table, column, fts),
+    ]
+
+
+def create_search_index(target, connection, **kw):
+    column = SEARCH_COLUMNS[target.name]
+    if connection.dialect.name == 'postgresql':
+        connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_{0}_{1}_trgm ON {0} USING gin ({1} gin_trgm_ops)'
+                           .format(target.name, column))
+    elif connection.dialect.name == 'sqlite' and has_trigram_fts():
+        for statement in fts_ddl(target.name, column):
+            connection.execute(statement)
+
+
+def drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS {}_fts'.format(target.name))
+
+
+for _model in (Movie, Actor):
+    event.listen(_model.__table__, 'after_create', create_search_index)
+    event.listen(_model.__table__, 'before_drop', drop_search_index)
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def trigrams(value):
+    value = value.lower()
+    return sorted({value[i:i + 3] for i in range(len(value) - 2)})
+
+
+def similarity(grams, value):
+    # shared trigrams over all trigrams, like pg_trgm's similarity()
+    other = set(trigrams(value))
+    return len(grams & other) / float(len(grams | other) or 1)
+
+
+def _fts_phrase(value):
+    return '"{}"'.format(value.replace('"', '""'))
+
+
+def typo_match(q):
+    # FTS5 query for the rows within one typo of `q`: for every position, the
+    # text left and right of it (pieces shorter than a trigram are dropped).
+    # One-piece alternatives containing a shorter one are dropped, it matches
+    # everything they would. Empty when `q` is too short for any.
+    alternatives = []
+    for i in range(len(q)):
+        pieces = [piece for piece in (q[:i], q[i + 1:]) if len(piece) >= 3]
+        if pieces:
+            alternatives.append(pieces)
+    singles = [pieces[0] for pieces in alternatives if len(pieces) == 1]
+    alternatives = [pieces for pieces in alternatives
+                    if len(pieces) == 2 or not any(pieces[0] != other and other in pieces[0] for other in singles)]
+    return ' OR '.join('(' + ' AND '.join(_fts_phrase(piece) for piece in pieces) + ')'
+                       for pieces in alternatives)
+
+
+def _fts_candidates(table, column, match, candidates, order, where='', params=None):
+    # At most `candidates` rows matching `match`, read in rowid order so the
+    # scan stops early, then ordered by `order`
+    fts = table.name + '_fts'
+    return db.session.execute(text(
+        "SELECT t.id AS id, t.{1} AS text FROM (SELECT rowid FROM {2} WHERE {2} MATCH :match LIMIT :candidates) "
+        "AS m JOIN {0} AS t ON t.id = m.rowid {3} ORDER BY {4}".format(table.name, column.name, fts, where, order)),
+        dict(params or {}, match=match, candidates=candidates)).fetchall()
+
+
+def search(model, q, limit=20, offset=0, candidates=200):
+    # Ranked (id, text) matches of `q` in the model's search column: prefix
+    # matches first, then substring matches, then near misses by trigram
+    # similarity. On SQLite at most `candidates` rows (or the page, if
+    # deeper) are ranked per stage. Returns (rows, has_more).
+    table = model.__table__
+    column = table.c[SEARCH_COLUMNS[table.name]]
+    prefix = _escape_like(q) + '%'
+    substring = '%' + _escape_like(q) + '%'
+    # the bind of this request, which may be a read replica
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        # both conditions are answered by the GIN index, `%` is pg_trgm's
+        # similarity operator (pg_trgm.similarity_threshold, 0.3 by default)
+        query = db.session.query(table.c.id, column.label('text')).filter(
+            or_(column.ilike(substring, escape='\\'), column.op('%')(q))).order_by(
+            column.ilike(prefix, escape='\\').desc(), column.ilike(substring, escape='\\').desc(),
+            func.similarity(column, q).desc(), table.c.id)
+        rows = query.limit(limit + 1).offset(offset).all()
+    elif dialect == 'sqlite' and has_trigram_fts() and len(q) >= 3:
+        # the quoted query is a substring match on the trigram index; near
+        # misses are only looked up when the substring matches run out
+        wanted = offset + limit + 1
+        candidates = max(candidates, wanted)
+        rows = _fts_candidates(table, column, _fts_phrase(q), candidates,
+                               "t.{} LIKE :prefix ESCAPE '\\' DESC, t.id".format(column.name),
+                               params={'prefix': prefix})[:wanted]
+        match = typo_match(q)
+        if len(rows) < wanted and match:
+            near = _fts_candidates(table, column, match, candidates, 't.id',
+                                   "WHERE t.{} NOT LIKE :substring ESCAPE '\\'".format(column.name),
+                                   {'substring': substring})
+            grams = set(trigrams(q))
+            near.sort(key=lambda row: (-similarity(grams, row.text), row.id))
+            rows += near[:wanted - len(rows)]
+        rows = rows[offset:]
+    else:
+        # queries shorter than a trigram, and other databases: a LIKE scan
+        rows = db.session.query(table.c.id, column.label('text')).filter(
+            column.ilike(substring, escape='\\')).order_by(
+            column.ilike(prefix, escape='\\').desc(), table.c.id).limit(limit + 1).offset(offset).all()
+    return rows[:limit], len(rows) > limit
@@ -0,0 +1,94 @@
+import os
+import re
+import traceback
+from collections import Counter
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Development guard against N+1 loops and query count regressions. When
+# enabled it records every statement a request issues together with the
+# line of our code that issued it, then checks the per route budget set with
+# @query_budget and looks for the same statement shape repeated, which is
+# what a lazy load inside a loop looks like. Violations are logged, or raised
+# as QueryBudgetExceeded when QUERY_GUARD is "raise" (tests).
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(max_statements=None, max_repeats=3):
+    # Declares how many statements a view may issue per request, and how
+    # often a single statement shape may repeat (None for no limit). Put it
+    # under @requires_auth.
+    def decorator(f):
+        f.query_budget = (max_statements, max_repeats)
+        return f
+    return decorator
+
+
+def statement_shape(statement):
+    # collapses whitespace, numbers and expanded IN lists so the same query
+    # with other parameters has the same shape
+    shape = re.sub(r'\s+', ' ', statement).strip()
+    shape = re.sub(r'\d+', 'N', shape)
+    return re.sub(r'\((?:\s*(?:\?|%\(\w+\)s|%s)\s*,?)+\)', '(?)', shape)
+
+
+def call_site():
+    # innermost frame of our own code, outside this module
+    for frame in reversed(traceback.extract_stack()[:-2]):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(PROJECT_DIR) and 'site-packages' not in filename \
+                and filename != os.path.abspath(__file__):
+            return '{}:{} in {}'.format(os.path.relpath(filename, PROJECT_DIR), frame.lineno, frame.name)
+    return 'unknown'
+
+
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'query_log' in g:
+        g.query_log.append((statement, call_site()))
+
+
+def check_queries(queries, budget, default_repeats):
+    # returns a list of problems found in `queries`, a list of (statement, call site)
+    max_statements, max_repeats = budget if budget else (None, default_repeats)
+    problems = []
+    if max_statements is not None and len(queries) > max_statements:
+        problems.append('{} statements issued, budget is {}'.format(len(queries), max_statements))
+    if max_repeats is not None:
+        shapes = Counter(statement_shape(statement) for statement, site in queries)
+        for shape, count in shapes.items():
+            if count > max_repeats:
+                problems.append('possible N+1: statement repeated {} times: {}'.format(count, shape))
+    return problems
+
+
+def init_query_guard(app, mode, max_repeats=3):
+    if mode not in ('log', 'raise'):
+        return
+    if not event.contains(Engine, 'before_cursor_execute', _record_statement):
+        event.listen(Engine, 'before_cursor_execute', _record_statement)
+
+    @app.before_request
+    def start_query_log():
+        g.query_log = []
+
+    @app.after_request
+    def check_query_log(response):
+        queries = g.pop('query_log', None)
+        view = app.view_functions.get(request.endpoint)
+        if queries is None or view is None:
+            return response
+
+        problems = check_queries(queries, getattr(view, 'query_budget', None), max_repeats)
+        if problems:
+            report = '{} {}: {}\n'.format(request.method, request.path, '; '.join(problems)) + '\n'.join(
+                '  {}  [{}]'.format(' '.join(statement.split()), site) for statement, site in queries)
+            if mode == 'raise':
+                raise QueryBudgetExceeded(report)
+            app.logger.warning(report)
+        return response
@@ -0,0 +1,200 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Admission control in requires_auth. The load shedder turns requests away
+# with 503 before their token is even verified when this worker has too many
+# requests in flight, or when connections recently waited too long on the
+# pool. The rate limiter then gives every (JWT sub, permission) pair a token
+# bucket and answers 429 once it is empty. Both answer with Retry-After and
+# do a constant amount of work per request.
+
+
+class Throttled(Exception):
+    def __init__(self, status_code, message, retry_after):
+        self.status_code = status_code
+        self.message = message
+        # whole seconds, as Retry-After wants
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+def take_token(tokens, updated, now, rate, burst):
+    # One bucket step: refills for the time since `updated` and takes a token.
+    # Returns (tokens left, seconds until one is available or 0).
+    # TOKEN_BUCKET_SCRIPT does the same on redis.
+    tokens = min(burst, tokens + max(0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class TokenBuckets:
+    # In-process buckets, the least recently used dropped past `max_keys`.
+    # A dropped bucket was idle and would have refilled anyway.
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        # 0 when a token was taken, else the seconds until one is available
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens, wait = take_token(tokens, updated, now, rate, burst)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+# take_token on a hash {tokens, ts}, atomic on the redis server. The wait is
+# returned as a string, redis truncates Lua numbers to integers.
+TOKEN_BUCKET_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisTokenBuckets:
+    # Shared between workers: the same token buckets, one EVAL per request.
+    # `client` is anything with the redis-py eval method. The time comes from
+    # the caller, so worker clocks should be in sync.
+    def __init__(self, client=None, url=None, prefix='capstone:ratelimit:'):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def take(self, key, rate, burst):
+        return float(self.client.eval(TOKEN_BUCKET_SCRIPT, 1, self.prefix + key, rate, burst, time.time()))
+
+
+class RateLimiter:
+
+    def __init__(self):
+        self.enabled = False
+        self.rate = 10.0
+        self.burst = 20
+        self.limits = {}
+        self.buckets = TokenBuckets()
+
+    def configure(self, enabled, rate, burst, limits=None, buckets=None):
+        # `limits` maps permissions to (rate, burst) overriding the default;
+        # a rate of 0 means no limit
+        self.enabled = enabled
+        self.rate = rate
+        self.burst = burst
+        self.limits = limits or {}
+        self.buckets = buckets or TokenBuckets()
+
+    def check(self, subject, permission):
+        if not self.enabled:
+            return
+        rate, burst = self.limits.get(permission, (self.rate, self.burst))
+        if rate <= 0:
+            return
+        wait = self.buckets.take('{}|{}'.format(subject, permission), rate, burst)
+        if wait:
+            raise Throttled(429, 'rate limit exceeded', wait)
+
+
+class LoadShedder:
+
+    # weight of the newest pool wait in the moving average, and the seconds
+    # it takes the average to halve without new checkouts
+    ALPHA = 0.2
+    HALF_LIFE = 1.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.configure()
+
+    def configure(self, max_in_flight=0, max_pool_wait=0, retry_after=1):
+        # 0 turns a check off
+        self.max_in_flight = max_in_flight
+        self.max_pool_wait = max_pool_wait
+        self.retry_after = retry_after
+        self._wait = 0.0
+        self._observed_at = time.monotonic()
+
+    def watch(self, engine):
+        # Times checkouts of the engine's pool like metrics.instrument_pool.
+        # Only waits of the pool serving requests should be watched.
+        pool = engine.pool
+        if getattr(pool, 'load_shedder_watched', False):
+            return
+        do_get = pool._do_get
+
+        def timed_do_get():
+            start = time.perf_counter()
+            try:
+                return do_get()
+            finally:
+                self.observe(time.perf_counter() - start)
+
+        pool._do_get = timed_do_get
+        pool.load_shedder_watched = True
+
+    def _decayed(self, now):
+        # the average decays while nothing is checked out, so a worker
+        # shedding every request recovers on its own
+        return self._wait * 0.5 ** ((now - self._observed_at) / self.HALF_LIFE)
+
+    def observe(self, seconds):
+        now = time.monotonic()
+        with self._lock:
+            self._wait = self._decayed(now) * (1 - self.ALPHA) + seconds * self.ALPHA
+            self._observed_at = now
+
+    def pool_wait(self):
+        with self._lock:
+            return self._decayed(time.monotonic())
+
+    def check(self):
+        if self.max_in_flight and self._in_flight >= self.max_in_flight:
+            raise Throttled(503, 'too many requests in flight', self.retry_after)
+        if self.max_pool_wait and self.pool_wait() > self.max_pool_wait:
+            raise Throttled(503, 'database connections are saturated', self.retry_after)
+
+    def enter(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def leave(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    @contextmanager
+    def track(self):
+        self.enter()
+        try:
+            yield
+        finally:
+            self.leave()
+
+
+rate_limiter = RateLimiter()
+load_shedder = LoadShedder()
+
+
+def make_buckets(config):
+    if config['RATE_LIMIT_BACKEND'] == 'redis':
+        return RedisTokenBuckets(url=config['RATE_LIMIT_URL'])
+    return TokenBuckets()
@@ -0,0 +1,131 @@
+import itertools
+import threading
+import time
+from functools import wraps
+from flask import _app_ctx_stack, _request_ctx_stack, has_app_context, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm, text
+
+# Read replica routing. Views decorated with @replicas.reads run their
+# queries on one replica per request, picked round-robin among the replicas
+# that passed their last health check. Everything else, and every flush, uses
+# the primary. After a successful @replicas.writes view the caller (the JWT
+# `sub`) is pinned to the primary for a few seconds so it reads its own
+# writes while the replicas catch up.
+
+
+class Replica:
+
+    def __init__(self, name, url, check_interval, engine_options=None):
+        self.name = name
+        self.url = url
+        self.engine = create_engine(url, **(engine_options or {}))
+        self.check_interval = check_interval
+        self.up = False
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def healthy(self):
+        # re-checked at most every `check_interval` seconds by one thread,
+        # the others use the last result
+        if self._checked_at is None or time.monotonic() - self._checked_at >= self.check_interval:
+            if self._lock.acquire(blocking=self._checked_at is None):
+                try:
+                    self.up = self._check()
+                    self._checked_at = time.monotonic()
+                finally:
+                    self._lock.release()
+        return self.up
+
+    def _check(self):
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+            return True
+        except Exception:
+            return False
+
+
+class ReplicaRouter:
+
+    def __init__(self):
+        self.replicas = []
+        self.pins = None
+        self.pin_seconds = 0
+        self._counter = itertools.count()
+
+    def configure(self, urls, check_interval=5, pin_seconds=5, pins=None, engine_options=None):
+        # `pins` is a cache backend (cache.LocalBackend or RedisBackend)
+        # holding the primary pins, shared between workers with redis.
+        # `engine_options(url)` returns the create_engine arguments for a replica.
+        for replica in self.replicas:
+            replica.engine.dispose()
+        self.replicas = [Replica('replica_{}'.format(i), url, check_interval,
+                                 engine_options(url) if engine_options else None)
+                         for i, url in enumerate(urls)]
+        self.pin_seconds = pin_seconds
+        self.pins = pins
+
+    def pick(self):
+        # the next healthy replica's engine, None when there is none
+        count = len(self.replicas)
+        for _ in range(count):
+            replica = self.replicas[next(self._counter) % count]
+            if replica.healthy():
+                return replica.engine
+        return None
+
+    def pin(self, subject):
+        if self.pins is not None and subject and self.pin_seconds > 0:
+            self.pins.set('pin:' + subject, b'1', self.pin_seconds)
+
+    def pinned(self, subject):
+        return self.pins is not None and bool(subject) and self.pins.get('pin:' + subject) is not None
+
+    def reads(self, f):
+        # for views under @requires_auth, which receive the JWT payload first
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            if self.replicas and not self.pinned(payload.get('sub')):
+                # kept on the request context, which outlives streamed responses
+                _request_ctx_stack.top.read_engine = self.pick()
+            return f(payload, *args, **kwargs)
+        return wrapper
+
+    def writes(self, f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            response = f(payload, *args, **kwargs)
+            status = response[1] if isinstance(response, tuple) else response.status_code
+            if status < 400:
+                self.pin(payload.get('sub'))
+            return response
+        return wrapper
+
+
+replicas = ReplicaRouter()
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kw):
+        # SQLAlchemy 1.4 also passes bind= and private keywords, which
+        # SignallingSession.get_bind does not take
+        if bind is not None:
+            return bind
+        if has_request_context() and not self._flushing:
+            engine = getattr(_request_ctx_stack.top, 'read_engine', None)
+            if engine is not None:
+                return engine
+        if has_app_context():
+            # background jobs (jobs.py) have an engine of their own
+            engine = getattr(_app_ctx_stack.top, 'job_engine', None)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
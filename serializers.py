@@ -0,0 +1,51 @@
+import json
+from datetime import date, datetime
+from flask import Response
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Response serialization for the read paths. Rows are read as plain column
+# tuples and turned into dicts by position, then encoded with orjson when it
+# is installed or the stdlib encoder otherwise. Dates are ISO 8601
+# (YYYY-MM-DD), the format the write endpoints accept.
+
+
+def _default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+if orjson is not None:
+    def dumps(value):
+        # bytes; orjson writes dates as ISO 8601 itself
+        return orjson.dumps(value, default=_default)
+else:
+    _encoder = json.JSONEncoder(default=_default, separators=(',', ':'), ensure_ascii=False)
+
+    def dumps(value):
+        return _encoder.encode(value).encode('utf-8')
+
+
+def json_response(value, status=200):
+    # drop-in for jsonify on the hot paths
+    return Response(dumps(value), status=status, mimetype='application/json')
+
+
+def rows_to_dicts(rows, columns):
+    # column tuples (from a query on `columns`) as dicts keyed on the column names
+    keys = [column.key for column in columns]
+    return [dict(zip(keys, row)) for row in rows]
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    # app.json_encoder, so jsonify and the test client also write ISO dates
+    # instead of Flask's HTTP date format
+    def default(self, value):
+        if isinstance(value, (date, datetime)):
+            return value.isoformat()
+        return super().default(value)
@@ -3,11 +3,33 @@ import unittest
 import json
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask
-from models import Actor, Movie, setup_db
-from app import create_app
+from sqlalchemy import event, create_engine
+from sqlalchemy.pool import QueuePool
+from models import (Actor, Movie, Tombstone, setup_db, keyset_page, movies_with_actors, engine_options,
+                    delete_movie_cascade, sqlalchemy_url, search, typo_match)
+from app import create_app, encode_cursor, decode_cursor, encode_token
 from models import db
-from config import bearer_tokens
+from config import bearer_tokens, pool_config
 from datetime import date
+import tempfile
+import threading
+import time
+from jose import jwk
+from auth import JWKSKeyStore, TokenCache, check_permissions, verify_decode_jwt, jwks_store, token_cache
+from testing import LocalSigner, LocalRedis
+from cache import ResponseCache, RedisBackend
+from query_guard import check_queries, statement_shape
+from serializers import dumps
+from replicas import replicas
+from metrics import instrument_pool, render
+from ratelimit import TokenBuckets, RedisTokenBuckets, load_shedder
+from bulk import import_file, export_file
+from app import validate_movie, validate_actor
+import asyncio
+try:
+    import asgi
+except ImportError:
+    asgi = None  # requirements-async.txt not installed
 
 class DeployTestCase(unittest.TestCase):
 
@@ -178,5 +200,960 @@ class DeployTestCase(unittest.TestCase):
         self.assertFalse(json.loads(res.data)['success'], False)
         self.assertEqual(json.loads(res.data)['message'] , 'not found')
 
+class LocalAuthTestCase(unittest.TestCase):
+    # app test case signing its own RS256 tokens against a local JWKS file
+
+    permissions = ['get:movies', 'get:actors', 'post:movie', 'post:actor', 'patch:movies',
+                   'patch:actors', 'delete:movie', 'delete:actor']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.signer = LocalSigner()
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        jwks_store.url = cls.signer.write_jwks(os.path.join(cls.tmpdir.name, 'jwks.json'))
+        jwks_store.clear()
+        token_cache.clear()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    app_config = {}
+
+    def setUp(self):
+        # every request made by these tests is held to its route's query budget
+        self.app = create_app(dict({'TESTING': True, 'QUERY_GUARD': 'raise'}, **self.app_config))
+        self.client = self.app.test_client
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.drop_all()
+        db.create_all()
+        self.headers = self.signer.headers(self.permissions)
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def seed(self, movies, actors_per_movie=0):
+        for i in range(movies):
+            movie = Movie(title='Movie {}'.format(i), release_date=date.today())
+            movie.actors = [Actor(name='Actor {}'.format(j), age=30, gender='female')
+                            for j in range(actors_per_movie)]
+            db.session.add(movie)
+        db.session.commit()
+
+class StreamingTestCase(LocalAuthTestCase):
+
+    def test_stream_json_document(self):
+        self.seed(5, 2)
+        res = self.client().get('/movies?stream=1', headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertTrue(data['success'])
+        self.assertEqual(len(data['movies']), 5)
+        self.assertEqual(len(data['movies'][0]['actors']), 2)
+        # like a WSGI server once the body is sent
+        res.close()
+
+    def test_stream_ndjson(self):
+        self.seed(3, 1)
+        headers = dict(self.headers, Accept='application/x-ndjson')
+        res = self.client().get('/actors', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(res.data.splitlines()), 3)
+        res.close()
+
+class FilterTestCase(LocalAuthTestCase):
+
+    def test_filter_actors(self):
+        self.seed(2, 3)
+        movie_id = Movie.query.first().id
+        db.session.add(Actor(name='Young', age=19, gender='male', movie_id=movie_id))
+        db.session.commit()
+
+        res = self.client().get('/actors?movie_id={}&gender=female&age_min=25'.format(movie_id),
+                                headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['Actors']), 3)
+        self.assertTrue(all(a['movie_id'] == movie_id for a in data['Actors']))
+
+    def test_invalid_actor_filters(self):
+        self.seed(1, 1)
+        for query in ('movie_id=abc', 'age_min=1.5', 'age_max=old'):
+            res = self.client().get('/actors?' + query, headers=self.headers)
+            self.assertEqual(res.status_code, 400)
+
+    def test_invalid_limit(self):
+        self.seed(1, 1)
+        for path in ('/movies', '/actors?since=0', '/search?q=movie'):
+            for limit in ('abc', '1.5', '0'):
+                sep = '&' if '?' in path else '?'
+                res = self.client().get(path + sep + 'limit=' + limit, headers=self.headers)
+                self.assertEqual(res.status_code, 400, (path, limit))
+
+    def test_filter_movies_by_release_date(self):
+        self.seed(2)
+        db.session.add(Movie(title='Old', release_date=date(1990, 1, 1)))
+        db.session.commit()
+
+        res = self.client().get('/movies?release_date_to=2000-01-01', headers=self.headers)
+        self.assertEqual([m['title'] for m in json.loads(res.data)['movies']], ['Old'])
+
+        res = self.client().get('/movies?release_date_from=not-a-date', headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+class SearchTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for title in ['The Godfather', 'Godzilla', 'Star Wars']:
+            db.session.add(Movie(title=title, release_date=date.today()))
+        db.session.commit()
+        db.session.add(Actor(name='Al Pacino', age=80, gender='male', movie_id=Movie.query.first().id))
+        db.session.commit()
+
+    def test_search_ranks_prefix_substring_and_typos(self):
+        res = self.client().get('/search?q=god&type=movies', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([m['title'] for m in json.loads(res.data)['movies']], ['Godzilla', 'The Godfather'])
+
+        res = self.client().get('/search?q=godfathr', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(data['movies'][0]['title'], 'The Godfather')
+        self.assertEqual(data['actors'], [])
+
+    def test_search_pages(self):
+        res = self.client().get('/search?q=god&type=movies&limit=1', headers=self.headers)
+        data = json.loads(res.data)
+        res = self.client().get('/search?q=god&type=movies&limit=1&cursor=' + data['next_cursor'],
+                                headers=self.headers)
+        self.assertEqual(json.loads(res.data)['movies'][0]['title'], 'The Godfather')
+
+    def test_typo_match_keeps_one_typo_alternatives(self):
+        self.assertEqual(typo_match('pacnio'), '("nio") OR ("pac")')
+        self.assertEqual(typo_match('abc'), '')
+
+    def test_search_ranks_beyond_candidate_cap(self):
+        # the cap grows to the page asked for
+        rows, has_more = search(Movie, 'god', limit=1, offset=1, candidates=1)
+        self.assertEqual([row.text for row in rows], ['The Godfather'])
+        self.assertFalse(has_more)
+
+    def test_search_requires_query(self):
+        res = self.client().get('/search?q=', headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+@unittest.skipIf(asgi is None, 'needs the packages in requirements-async.txt')
+class ASGITestCase(LocalAuthTestCase):
+
+    def asgi_get(self, path, query=''):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+                 'query_string': query.encode(), 'scheme': 'http', 'http_version': '1.1',
+                 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+                 'headers': [(k.lower().encode(), v.encode()) for k, v in self.headers.items()]}
+        asyncio.run(asgi.app(scope, receive, send))
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], json.loads(body)
+
+    def test_native_listing_matches_flask(self):
+        self.seed(3, 2)
+        for path in ('/movies', '/actors'):
+            status, data = self.asgi_get(path, 'limit=2')
+            self.assertEqual(status, 200)
+            self.assertEqual(data, json.loads(self.client().get(path + '?limit=2', headers=self.headers).data))
+
+    def test_other_routes_reach_flask(self):
+        self.seed(2, 1)
+        status, data = self.asgi_get('/movies', 'since=0')
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data['movies']), 2)
+
+class SerializerTestCase(LocalAuthTestCase):
+
+    def test_dates_are_iso(self):
+        self.assertEqual(json.loads(dumps({'day': date(2020, 5, 1)})), {'day': '2020-05-01'})
+
+        db.session.add(Movie(title='Dated', release_date=date(2020, 5, 1)))
+        db.session.commit()
+        movie = json.loads(self.client().get('/movies', headers=self.headers).data)['movies'][0]
+        self.assertEqual(movie['release_date'], '2020-05-01')
+
+    def test_actor_listing_keys(self):
+        self.seed(1, 1)
+        actor = json.loads(self.client().get('/actors', headers=self.headers).data)['Actors'][0]
+        self.assertEqual(sorted(actor), ['age', 'gender', 'id', 'movie_id', 'name'])
+
+class ReplicaTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        self.replica_dir = tempfile.TemporaryDirectory()
+        url = 'sqlite:///' + os.path.join(self.replica_dir.name, 'replica.db')
+        self.replica = create_engine(url)
+        db.Model.metadata.create_all(self.replica)
+        self.replica.execute(Movie.__table__.insert(), title='From replica')
+        self.app_config = {'DATABASE_REPLICA_URLS': [url]}
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        replicas.configure([])
+        self.replica.dispose()
+        self.replica_dir.cleanup()
+
+    def titles(self):
+        res = self.client().get('/movies', headers=self.headers)
+        return [movie['title'] for movie in json.loads(res.data)['movies']]
+
+    def test_reads_replica_until_own_write(self):
+        self.assertEqual(self.titles(), ['From replica'])
+        res = self.client().post('/movies/create', json={'title': 'From primary'}, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.titles(), ['From primary'])
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        replicas.configure(['sqlite:///' + os.path.join(self.replica_dir.name, 'missing', 'replica.db')])
+        self.seed(1)
+        self.assertEqual(self.titles(), ['Movie 0'])
+
+    def test_session_takes_bind_and_heroku_urls(self):
+        # SQLAlchemy 1.4 sessions pass bind= to get_bind
+        self.assertIs(db.session.get_bind(bind=self.replica), self.replica)
+        self.assertEqual(sqlalchemy_url('postgres://u:p@host/db'), 'postgresql://u:p@host/db')
+
+class ImportExportTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_import_resolves_movies_and_reports_bad_rows(self):
+        movies = self.write('movies.csv', 'title,release_date\nJaws,1975-06-20\nAlien,\n')
+        actors = self.write('actors.ndjson', '\n'.join([
+            json.dumps({'name': 'Roy', 'age': 60, 'gender': 'male', 'movie_title': 'Jaws'}),
+            json.dumps({'name': 'Sigourney', 'age': 30, 'gender': 'female', 'movie_title': 'Alien'}),
+            json.dumps({'name': 'Nobody', 'age': 30, 'movie_title': 'Missing'}),
+            json.dumps({'name': 'No age', 'movie_title': 'Jaws'})]))
+
+        self.assertEqual(import_file('movies', movies, validate_movie, chunk_size=1)['rows'], 2)
+        result = import_file('actors', actors, validate_actor, chunk_size=2)
+        self.assertEqual((result['rows'], result['skipped']), (2, 2))
+        self.assertEqual(sorted(error['line'] for error in result['errors']), [3, 4])
+        jaws = Movie.query.filter_by(title='Jaws').one()
+        self.assertEqual([actor.name for actor in jaws.actors], ['Roy'])
+
+    def test_export_round_trip(self):
+        self.seed(3, 2)
+        path = os.path.join(self.tmpdir.name, 'actors.csv')
+        self.assertEqual(export_file('actors', path)['rows'], 6)
+        db.session.execute(Actor.__table__.delete())
+        db.session.commit()
+
+        result = import_file('actors', path, validate_actor, keep_ids=True)
+        self.assertEqual((result['rows'], result['skipped']), (6, 0))
+        self.assertEqual(Actor.query.count(), 6)
+
+class BatchTestCase(LocalAuthTestCase):
+
+    def batch(self, operations, headers=None):
+        res = self.client().post('/batch', json={'operations': operations}, headers=headers or self.headers)
+        return res.status_code, json.loads(res.data)
+
+    def test_batch_with_references(self):
+        self.seed(1, 1)
+        actor_id = Actor.query.one().id
+        status, data = self.batch([
+            {'path': 'movies/create', 'body': {'title': 'Heat', 'release_date': '1995-12-15'}, 'ref': 'heat'},
+            {'path': 'actors/create', 'body': {'name': 'Val', 'age': 34, 'gender': 'male', 'movie_id': '$heat'}},
+            {'path': 'actors/patch/{}'.format(actor_id), 'body': {'movie_id': '$heat'}}
+        ])
+
+        self.assertEqual(status, 200)
+        heat = data['results'][0]['created']
+        self.assertEqual(data['results'][1]['actor']['movie_id'], heat)
+        self.assertEqual(len(Movie.query.get(heat).actors), 2)
+
+    def test_version_rows_locked_in_fixed_order(self):
+        self.seed(1)
+        movie_id = Movie.query.one().id
+        locked = []
+        def before_cursor_execute(conn, cursor, statement, parameters, *args):
+            if statement.lstrip().startswith('SELECT table_versions.version'):
+                locked.append(parameters[0])
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            status, data = self.batch([
+                {'path': 'actors/create', 'body': {'name': 'Val', 'age': 34, 'movie_id': movie_id}},
+                {'path': 'movies/create', 'body': {'title': 'Heat'}}
+            ])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(status, 200)
+        self.assertEqual(locked[:2], ['movies', 'actors'])
+
+    def test_failed_operation_rolls_back_batch(self):
+        status, data = self.batch([
+            {'path': 'movies/create', 'body': {'title': 'Kept?'}},
+            {'path': 'actors/delete/100000'}
+        ])
+
+        self.assertEqual((status, data['index']), (404, 1))
+        self.assertEqual(Movie.query.count(), 0)
+
+    def test_permissions_checked_before_running(self):
+        headers = self.signer.headers(['post:movie'])
+        status, data = self.batch([
+            {'path': 'movies/create', 'body': {'title': 'Allowed'}},
+            {'path': 'movies/delete/1'}
+        ], headers)
+
+        self.assertEqual(status, 401)
+        self.assertEqual(Movie.query.count(), 0)
+
+class SparseFieldsTestCase(LocalAuthTestCase):
+
+    def get(self, path):
+        res = self.client().get(path, headers=self.headers)
+        return res.status_code, json.loads(res.data)
+
+    def test_fields_and_expand(self):
+        self.seed(2, 2)
+        status, data = self.get('/movies?fields=title')
+        self.assertEqual(status, 200)
+        self.assertEqual(sorted(data['movies'][0]), ['id', 'title'])
+
+        status, data = self.get('/movies?fields=title&expand=actors')
+        self.assertEqual(sorted(data['movies'][0]), ['actors', 'id', 'title'])
+        self.assertEqual(len(data['movies'][0]['actors']), 2)
+
+        status, data = self.get('/actors?fields=name')
+        self.assertEqual(sorted(data['Actors'][0]), ['id', 'name'])
+
+    def test_default_listing_unchanged(self):
+        self.seed(1, 1)
+        status, data = self.get('/movies')
+        self.assertEqual(sorted(data['movies'][0]), ['actors', 'id', 'release_date', 'title'])
+
+    def test_unknown_field(self):
+        self.seed(1)
+        self.assertEqual(self.get('/movies?fields=budget')[0], 400)
+        self.assertEqual(self.get('/actors?expand=movies')[0], 400)
+
+class CascadeDeleteTestCase(LocalAuthTestCase):
+
+    def test_cascade_delete(self):
+        self.seed(2, 5)
+        movie_id = Movie.query.order_by(Movie.id).first().id
+        res = self.client().delete('/movies/delete/{}?cascade=delete'.format(movie_id), headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['actors_deleted'], 5)
+        self.assertEqual(Actor.query.count(), 5)
+        self.assertIsNone(Movie.query.get(movie_id))
+
+    def test_cascade_runs_in_chunks(self):
+        self.seed(1, 5)
+        movie_id = Movie.query.one().id
+        chunks = []
+        self.assertEqual(delete_movie_cascade(movie_id, 'delete', chunk_size=2, progress=chunks.append), (True, 5))
+        self.assertEqual(chunks, [2, 2, 1])
+        self.assertEqual(Tombstone.query.filter_by(table_name='actors').count(), 5)
+
+    def test_cascade_reassign(self):
+        self.seed(2, 3)
+        first, second = [movie.id for movie in Movie.query.order_by(Movie.id)]
+        res = self.client().delete('/movies/delete/{}?cascade=reassign&to={}'.format(first, second),
+                                   headers=self.headers)
+
+        self.assertEqual(json.loads(res.data)['actors_reassigned'], 3)
+        self.assertEqual(Actor.query.filter_by(movie_id=second).count(), 6)
+
+    def test_reassign_needs_target(self):
+        self.seed(1, 1)
+        movie_id = Movie.query.one().id
+        res = self.client().delete('/movies/delete/{}?cascade=reassign'.format(movie_id), headers=self.headers)
+        self.assertEqual(res.status_code, 422)
+
+class JobsTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.app_config = {'JOB_DIR': self.tmpdir.name, 'JOB_WORKERS': 1, 'JOB_MAX_QUEUED': 1}
+        super().setUp()
+        self.jobs = self.app.extensions['jobs']
+
+    def tearDown(self):
+        self.jobs.shutdown()
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def finish(self, res):
+        self.assertEqual(res.status_code, 202)
+        job = json.loads(res.data)['job']
+        # Werkzeug before 2.1 makes Location absolute
+        self.assertTrue(res.headers['Location'].endswith('/jobs/' + job['id']))
+        self.jobs.wait(job['id'], timeout=30)
+        res = self.client().get('/jobs/' + job['id'], headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)['job']
+
+    def test_import_job(self):
+        body = 'title,release_date\nJaws,1975-06-20\nAlien,1979-05-25\n'
+        job = self.finish(self.client().post('/import/movies', data=body, content_type='text/csv',
+                                             headers=self.headers))
+
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual((job['rows'], job['result']['skipped']), (2, 0))
+        self.assertEqual(Movie.query.count(), 2)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_export_job_result(self):
+        self.seed(2, 3)
+        job = self.finish(self.client().post('/export/actors?format=ndjson', headers=self.headers))
+        self.assertEqual(job['result']['rows'], 6)
+
+        res = self.client().get(job['result']['download'], headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.data.splitlines()), 6)
+        res.close()
+
+    def test_async_cascade_delete(self):
+        self.seed(1, 5)
+        movie_id = Movie.query.one().id
+        job = self.finish(self.client().delete('/movies/delete/{}?cascade=delete&async=1'.format(movie_id),
+                                               headers=self.headers))
+
+        self.assertEqual(job['result'], {'deleted': movie_id, 'actors_deleted': 5})
+        self.assertEqual(Actor.query.count(), 0)
+
+    def test_jobs_are_private(self):
+        res = self.client().post('/export/movies', headers=self.headers)
+        job_id = json.loads(res.data)['job']['id']
+        self.jobs.wait(job_id, timeout=30)
+        other = self.signer.headers(self.permissions, sub='local|other')
+        self.assertEqual(self.client().get('/jobs/' + job_id, headers=other).status_code, 404)
+
+    def test_expired_job_files_swept(self):
+        old, new, other = (os.path.join(self.tmpdir.name, name) for name in ('job-a.csv', 'job-b.csv', 'notes.txt'))
+        for name in (old, new, other):
+            open(name, 'w').close()
+        past = time.time() - self.jobs.ttl - 60
+        os.utime(old, (past, past))
+        os.utime(other, (past, past))
+        self.jobs.sweep()
+
+        self.assertEqual([os.path.exists(name) for name in (old, new, other)], [False, True, True])
+
+    def test_full_queue_sheds_jobs(self):
+        release = threading.Event()
+        for _ in range(2):
+            self.jobs.submit('test', 'local|tester', lambda progress: release.wait(30))
+        res = self.client().post('/export/movies', headers=self.headers)
+        release.set()
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '30')
+
+class RateLimitTestCase(LocalAuthTestCase):
+
+    app_config = {'RATE_LIMIT_ENABLED': True, 'RATE_LIMITS': {'get:movies': (1, 2)}}
+
+    def test_bucket_per_subject_and_permission(self):
+        self.seed(1)
+        statuses = [self.client().get('/movies', headers=self.headers).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+        res = self.client().get('/movies', headers=self.headers)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        other = self.signer.headers(self.permissions, sub='local|other')
+        self.assertEqual(self.client().get('/movies', headers=other).status_code, 200)
+        self.assertNotEqual(self.client().get('/actors', headers=self.headers).status_code, 429)
+
+    def test_bucket_refills(self):
+        buckets = TokenBuckets()
+        self.assertEqual(buckets.take('key', 20, 1), 0)
+        self.assertGreater(buckets.take('key', 20, 1), 0)
+        time.sleep(0.1)
+        self.assertEqual(buckets.take('key', 20, 1), 0)
+
+    def test_shared_buckets(self):
+        buckets = RedisTokenBuckets(client=LocalRedis())
+        self.assertEqual([buckets.take('key', 20, 2) > 0 for _ in range(3)], [False, False, True])
+        self.assertEqual(buckets.take('other', 20, 2), 0)
+        time.sleep(0.1)
+        self.assertEqual(buckets.take('key', 20, 2), 0)
+
+class LoadSheddingTestCase(LocalAuthTestCase):
+
+    app_config = {'SHED_MAX_IN_FLIGHT': 1, 'SHED_MAX_POOL_WAIT': 0.5, 'SHED_RETRY_AFTER': 2}
+
+    def test_sheds_when_requests_in_flight(self):
+        self.seed(1)
+        self.assertEqual(self.client().get('/movies', headers=self.headers).status_code, 200)
+        with load_shedder.track():
+            res = self.client().get('/movies', headers=self.headers)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '2')
+
+    def test_streamed_body_counts_until_closed(self):
+        self.seed(1, 1)
+        res = self.client().get('/actors?stream=1', headers=self.headers)
+        self.assertEqual(load_shedder._in_flight, 1)
+        self.assertEqual(self.client().get('/movies', headers=self.headers).status_code, 503)
+        res.close()
+        self.assertEqual(load_shedder._in_flight, 0)
+
+    def test_sheds_on_pool_wait_and_recovers(self):
+        for _ in range(10):
+            load_shedder.observe(5)
+        self.assertEqual(self.client().get('/movies', headers=self.headers).status_code, 503)
+        load_shedder._observed_at -= 10 * load_shedder.HALF_LIFE
+        self.assertLess(load_shedder.pool_wait(), 0.5)
+
+class BulkCreateTestCase(LocalAuthTestCase):
+
+    def test_bulk_create_actors(self):
+        self.seed(1)
+        movie_id = Movie.query.first().id
+        actors = [{'name': 'Actor {}'.format(i), 'age': 20 + i, 'movie_id': movie_id} for i in range(50)]
+        res = self.client().post('/actors/create', json=actors, headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        created = json.loads(res.data)['created']
+        self.assertEqual(len(created), 50)
+        self.assertEqual(Actor.query.count(), 50)
+
+    def test_bulk_create_reports_every_invalid_item(self):
+        self.seed(1)
+        movie_id = Movie.query.first().id
+        actors = [{'name': 'Valid', 'age': 30, 'movie_id': movie_id},
+                  {'age': 30, 'movie_id': movie_id},
+                  {'name': 'No movie', 'age': 30, 'movie_id': movie_id + 1000}]
+        res = self.client().post('/actors/create', json=actors, headers=self.headers)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual([e['index'] for e in json.loads(res.data)['errors']], [1, 2])
+        self.assertEqual(Actor.query.count(), 0)
+
+class WriteHandlerTestCase(LocalAuthTestCase):
+
+    def test_create_movie_returns_row(self):
+        res = self.client().post('/movies/create', json={'title': 'New', 'release_date': '2020-05-01'},
+                                 headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertEqual(data['new_movie']['title'], 'New')
+        self.assertEqual(data['created'], Movie.query.one().id)
+
+    def test_patch_actor_updates_given_fields(self):
+        self.seed(1, 1)
+        actor = Actor.query.one()
+        res = self.client().patch('/actors/patch/{}'.format(actor.id), json={'age': 45}, headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertEqual(data['actor']['age'], 45)
+        self.assertEqual(data['actor']['name'], 'Actor 0')
+
+    def test_movie_field_types_checked(self):
+        for body in ({'title': 5}, {'title': ['New']}, {'title': 'New', 'release_date': 20200501},
+                     {'title': 'New', 'release_date': ['2020-05-01']}):
+            res = self.client().post('/movies/create', json=body, headers=self.headers)
+            self.assertEqual(res.status_code, 422)
+        self.assertEqual(Movie.query.count(), 0)
+
+    def test_actor_field_types_checked(self):
+        self.seed(1, 1)
+        movie_id, actor_id = Movie.query.one().id, Actor.query.one().id
+        valid = {'name': 'New', 'age': 30, 'gender': 'female', 'movie_id': movie_id}
+        bodies = [dict(valid, name=['x']), dict(valid, name={'x': 1}), dict(valid, gender=['f']),
+                  dict(valid, age=True), dict(valid, movie_id=True)]
+        for body in bodies:
+            res = self.client().post('/actors/create', json=body, headers=self.headers)
+            self.assertEqual(res.status_code, 422)
+
+        res = self.client().post('/actors/create', json=[valid] + bodies, headers=self.headers)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual([e['index'] for e in json.loads(res.data)['errors']], [1, 2, 3, 4, 5])
+
+        res = self.client().patch('/actors/patch/{}'.format(actor_id), json={'name': ['x']}, headers=self.headers)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(Actor.query.count(), 1)
+
+    def test_patch_missing_movie(self):
+        res = self.client().patch('/movies/patch/100000', json={'title': 'x'}, headers=self.headers)
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_delete_actor(self):
+        self.seed(1, 1)
+        actor_id = Actor.query.one().id
+        res = self.client().delete('/actors/delete/{}'.format(actor_id), headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['deleted'], actor_id)
+        self.assertEqual(Actor.query.count(), 0)
+
+        res = self.client().delete('/actors/delete/{}'.format(actor_id), headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+class ResponseCacheTestCase(LocalAuthTestCase):
+
+    def test_repeat_get_served_from_cache(self):
+        self.seed(2)
+        first = self.client().get('/movies', headers=self.headers)
+        second = self.client().get('/movies', headers=self.headers)
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+
+    def test_write_invalidates(self):
+        self.seed(1)
+        self.client().get('/movies', headers=self.headers)
+        self.client().post('/movies/create', json={'title': 'Another'}, headers=self.headers)
+        res = self.client().get('/movies', headers=self.headers)
+
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(json.loads(res.data)['movies']), 2)
+
+    def test_shared_backend_generations(self):
+        cache = ResponseCache(RedisBackend(client=LocalRedis()))
+        cache.invalidate('movies')
+        cache.invalidate('movies')
+
+        self.assertEqual(cache.generation('movies'), 2)
+        self.assertEqual(cache.generation('actors'), 0)
+
+class ConditionalGetTestCase(LocalAuthTestCase):
+
+    def test_matching_etag_returns_304(self):
+        self.seed(2, 1)
+        res = self.client().get('/actors?limit=10', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('ETag', res.headers)
+        etag = res.headers['ETag']
+
+        res = self.client().get('/actors?limit=10', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(res.data, b'')
+
+    def test_write_changes_etag(self):
+        self.seed(1)
+        etag = self.client().get('/movies', headers=self.headers).headers['ETag']
+        self.client().post('/movies/create', json={'title': 'Another'}, headers=self.headers)
+
+        res = self.client().get('/movies', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+class ChangeFeedTestCase(LocalAuthTestCase):
+
+    def test_feed_returns_changes_and_deletes(self):
+        self.seed(1)
+        movie_id = Movie.query.one().id
+        self.client().post('/actors/create', json=[{'name': 'A', 'age': 20, 'movie_id': movie_id},
+                                                   {'name': 'B', 'age': 21, 'movie_id': movie_id}],
+                           headers=self.headers)
+        res = self.client().get('/actors?since=0', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(len(data['Actors']), 2)
+        self.assertFalse(data['has_more'])
+
+        first, second = [actor['id'] for actor in data['Actors']]
+        self.client().patch('/actors/patch/{}'.format(first), json={'age': 50}, headers=self.headers)
+        self.client().delete('/actors/delete/{}'.format(second), headers=self.headers)
+
+        data = json.loads(self.client().get('/actors?since=' + data['next_since'], headers=self.headers).data)
+        self.assertEqual([actor['id'] for actor in data['Actors']], [first])
+        self.assertEqual(data['deleted'], [second])
+
+        data = json.loads(self.client().get('/actors?since=' + data['next_since'], headers=self.headers).data)
+        self.assertEqual((data['Actors'], data['deleted']), ([], []))
+
+    def test_feed_starts_with_unversioned_rows(self):
+        # rows added without a write path keep version 0
+        self.seed(1, 3)
+        movie_id = Movie.query.one().id
+        self.assertEqual(Movie.query.one().version, 0)
+        self.client().post('/actors/create', json=[{'name': 'A', 'age': 20, 'movie_id': movie_id}], headers=self.headers)
+        data = json.loads(self.client().get('/movies?since=0', headers=self.headers).data)
+        self.assertEqual([movie['id'] for movie in data['movies']], [movie_id])
+        data = json.loads(self.client().get('/movies?since=' + data['next_since'], headers=self.headers).data)
+        self.assertEqual(data['movies'], [])
+
+        seen, since = [], '0'
+        while True:
+            data = json.loads(self.client().get('/actors?since={}&limit=1'.format(since), headers=self.headers).data)
+            seen += [actor['id'] for actor in data['Actors']]
+            since = data['next_since']
+            if not data['has_more']:
+                break
+        self.assertEqual(len(seen), 4)
+        self.assertEqual(len(set(seen)), 4)
+
+    def test_feed_pages_within_one_version(self):
+        self.seed(1)
+        movie_id = Movie.query.one().id
+        self.client().post('/actors/create', json=[{'name': str(i), 'age': 20, 'movie_id': movie_id}
+                                                   for i in range(5)], headers=self.headers)
+        seen = []
+        since = '0'
+        while True:
+            data = json.loads(self.client().get('/actors?since={}&limit=2'.format(since), headers=self.headers).data)
+            seen += [actor['id'] for actor in data['Actors']]
+            since = data['next_since']
+            if not data['has_more']:
+                break
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+    def test_feed_pages_tombstones(self):
+        self.seed(1, 5)
+        movie_id = Movie.query.one().id
+        since = json.loads(self.client().get('/actors?since=0', headers=self.headers).data)['next_since']
+        # five tombstones in one version
+        delete_movie_cascade(movie_id, 'delete')
+        deleted = []
+        while True:
+            data = json.loads(self.client().get('/actors?since={}&limit=2'.format(since), headers=self.headers).data)
+            self.assertLessEqual(len(data['deleted']), 2)
+            deleted += data['deleted']
+            since = data['next_since']
+            if not data['has_more']:
+                break
+        self.assertEqual(len(deleted), 5)
+        self.assertEqual(len(set(deleted)), 5)
+
+    def test_crafted_cursor_is_a_bad_request(self):
+        res = self.client().get('/actors?since=' + encode_token({'v': 0, 'id': 'x'}), headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+class MetricsTestCase(LocalAuthTestCase):
+
+    def test_metrics_exposed(self):
+        self.seed(1)
+        self.client().get('/movies', headers=self.headers)
+        res = self.client().get('/metrics')
+
+        self.assertEqual(res.status_code, 200)
+        body = res.data.decode('utf-8')
+        self.assertIn('http_request_duration_seconds_count{endpoint="get_movies",method="GET",status="200"}', body)
+        self.assertIn('db_statements_per_request_bucket{endpoint="get_movies"', body)
+        self.assertIn('auth_verification_seconds_count{endpoint="get_movies"}', body)
+
+    def test_pool_gauges_labelled(self):
+        engine = create_engine('sqlite://', poolclass=QueuePool, pool_size=3)
+        instrument_pool(engine, 'test')
+        with engine.connect():
+            body = render()
+
+        self.assertIn('db_pool_checked_out{pool="test"} 1', body)
+        self.assertIn('db_pool_size{pool="test"} 3', body)
+        self.assertEqual(body.count('# TYPE db_pool_size gauge'), 1)
+        engine.dispose()
+
+class QueryGuardTestCase(unittest.TestCase):
+
+    def test_repeated_shapes_flagged(self):
+        queries = [('SELECT * FROM actors WHERE actors.movie_id = ?', 'models.py:1') for i in range(4)]
+        problems = check_queries(queries, None, 3)
+
+        self.assertEqual(len(problems), 1)
+        self.assertIn('N+1', problems[0])
+
+    def test_budget(self):
+        queries = [('SELECT 1', 'app.py:1'), ('SELECT 2', 'app.py:2')]
+
+        self.assertEqual(check_queries(queries, (2, 3), 3), [])
+        self.assertEqual(len(check_queries(queries, (1, 3), 3)), 1)
+
+    def test_in_lists_share_a_shape(self):
+        self.assertEqual(statement_shape('SELECT a FROM t WHERE id IN (?, ?)'),
+                         statement_shape('SELECT a FROM t WHERE id IN (?, ?, ?, ?)'))
+
+class EngineOptionsTestCase(unittest.TestCase):
+
+    def test_pool_options(self):
+        self.assertEqual(engine_options('sqlite:////tmp/agency.db'), {})
+        options = engine_options('postgresql://postgres@localhost:5432/agency')
+        self.assertEqual(options['pool_size'], pool_config['DB_POOL_SIZE'])
+        self.assertEqual(options['pool_pre_ping'], pool_config['DB_POOL_PRE_PING'])
+
+class PaginationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.drop_all()
+        db.create_all()
+        for i in range(5):
+            db.session.add(Movie(title='Movie {}'.format(i)))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_keyset_pages_cover_table(self):
+        first, has_more = keyset_page(Movie, None, 3)
+        self.assertTrue(has_more)
+        second, has_more = keyset_page(Movie, first[-1].id, 3)
+        self.assertFalse(has_more)
+        self.assertEqual([m.id for m in first + second], sorted(m.id for m in Movie.query.all()))
+
+    def test_cursor_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor(42)), 42)
+
+class MovieListingQueryCountTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def seed(self, movies):
+        for i in range(movies):
+            movie = Movie(title='Movie {}'.format(i))
+            movie.actors = [Actor(name='Actor {}'.format(j), age=30, gender='female') for j in range(3)]
+            db.session.add(movie)
+        db.session.commit()
+        db.session.expire_all()
+
+    def count_statements(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            page, has_more = movies_with_actors(None, 1000)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return len(statements), page
+
+    def test_statement_count_constant(self):
+        self.seed(2)
+        small, page = self.count_statements()
+        self.assertEqual(len(page[0]['actors']), 3)
+
+        self.seed(20)
+        large, page = self.count_statements()
+        self.assertEqual(len(page), 22)
+        self.assertEqual(small, large)
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.signer = LocalSigner()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.url = self.signer.write_jwks(os.path.join(self.tmpdir.name, 'jwks.json'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_keys_fetched_once(self):
+        store = JWKSKeyStore(self.url)
+        self.assertIsNotNone(store.get_key(self.signer.kid))
+        self.assertIsNotNone(store.get_key(self.signer.kid))
+        self.assertEqual(store.fetch_count, 1)
+
+    def test_unknown_kid_refetch_rate_limited(self):
+        store = JWKSKeyStore(self.url, min_refetch_interval=60)
+        store.get_key(self.signer.kid)
+        self.assertIsNone(store.get_key('unknown'))
+        self.assertIsNone(store.get_key('unknown'))
+        self.assertEqual(store.fetch_count, 1)
+
+    def test_last_good_keys_kept_on_failure(self):
+        store = JWKSKeyStore(self.url, ttl=0, min_refetch_interval=0)
+        store.get_key(self.signer.kid)
+        store.url = 'file:///nonexistent/jwks.json'
+        self.assertIsNotNone(store.get_key(self.signer.kid))
+        self.assertEqual(store.fetch_count, 2)
+
+    def test_cached_key_verifies_tokens(self):
+        # runs jwt.decode of the installed python-jose on the cached key form
+        jwks_store.url = self.url
+        jwks_store.clear()
+        payload = verify_decode_jwt(self.signer.token(['get:movies']))
+        self.assertEqual(payload['permissions'], ['get:movies'])
+
+    def test_key_parsed_once(self):
+        jwks_store.url = self.url
+        jwks_store.clear()
+        parsed = []
+        construct = jwk.construct
+
+        def counting_construct(key_data, algorithm=None):
+            if isinstance(key_data, dict):
+                parsed.append(key_data['kid'])
+            return construct(key_data, algorithm)
+
+        jwk.construct = counting_construct
+        try:
+            for permission in ('get:movies', 'get:actors'):
+                verify_decode_jwt(self.signer.token([permission]))
+        finally:
+            jwk.construct = construct
+        self.assertEqual(parsed, [self.signer.kid])
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def test_hit_and_permissions_frozenset(self):
+        cache = TokenCache(maxsize=2)
+        cache.put('token', {'exp': time.time() + 60, 'permissions': ['get:movies']})
+        exp, payload, permissions = cache.get('token')
+
+        self.assertEqual(permissions, frozenset(['get:movies']))
+        self.assertTrue(check_permissions('get:movies', payload, permissions))
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_expired_entry_is_a_miss(self):
+        cache = TokenCache()
+        cache.put('token', {'exp': time.time() - 1, 'permissions': []})
+
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.misses, 1)
+
+    def test_lru_eviction(self):
+        cache = TokenCache(maxsize=2)
+        for token in ('a', 'b', 'c'):
+            cache.put(token, {'exp': time.time() + 60})
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(len(cache), 2)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,96 @@
+import base64
+import json
+import math
+import time
+from Crypto.PublicKey import RSA
+from jose import jwt
+from config import auth_config
+
+# Local stand-in for the Auth0 tenant: an RSA key pair, the matching JWKS
+# document and RS256 tokens with the audience and issuer auth.py expects.
+
+
+def _b64_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+class LocalSigner:
+
+    def __init__(self, kid='local-test-key', bits=2048):
+        self.kid = kid
+        self.key = RSA.generate(bits)
+        self.private_pem = self.key.export_key('PEM').decode('ascii')
+
+    def jwks(self):
+        public = self.key.publickey()
+        return {
+            'keys': [{
+                'kty': 'RSA',
+                'kid': self.kid,
+                'use': 'sig',
+                'alg': 'RS256',
+                'n': _b64_uint(public.n),
+                'e': _b64_uint(public.e)
+            }]
+        }
+
+    def write_jwks(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.jwks(), f)
+        return 'file://' + path
+
+    def token(self, permissions, sub='local|tester', expires_in=3600):
+        now = int(time.time())
+        claims = {
+            'iss': 'https://' + auth_config['AUTH0_DOMAIN'] + '/',
+            'aud': auth_config['API_AUDIENCE'],
+            'sub': sub,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256', headers={'kid': self.kid})
+
+    def headers(self, permissions, **kwargs):
+        return {'Authorization': 'Bearer ' + self.token(permissions, **kwargs)}
+
+
+class LocalRedis:
+    # In-memory stand-in for the redis-py client methods the shared backends use.
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+
+    def _alive(self, key):
+        if key in self.expiry and self.expiry[key] <= time.time():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return key in self.data
+
+    def get(self, key):
+        return self.data.get(key) if self._alive(key) else None
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode('utf-8')
+        if ex is not None:
+            self.expiry[key] = time.time() + ex
+        else:
+            self.expiry.pop(key, None)
+        return True
+
+    def incr(self, key, amount=1):
+        value = int(self.get(key) or 0) + amount
+        self.data[key] = str(value).encode('utf-8')
+        return value
+
+    def eval(self, script, numkeys, *args):
+        # only runs ratelimit.TOKEN_BUCKET_SCRIPT, through its Python twin
+        from ratelimit import TOKEN_BUCKET_SCRIPT, take_token
+        if script != TOKEN_BUCKET_SCRIPT:
+            raise NotImplementedError('LocalRedis only evaluates the token bucket script')
+        key, rate, burst, now = args[0], float(args[1]), float(args[2]), float(args[3])
+        state = json.loads(self.get(key) or 'null') or [burst, now]
+        tokens, wait = take_token(state[0], state[1], now, rate, burst)
+        self.set(key, json.dumps([tokens, now]), ex=int(math.ceil(burst / rate)) + 1)
+        return str(wait).encode('utf-8')